@@ -0,0 +1,294 @@
+import importlib.util
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+from types import SimpleNamespace
+
+import torch
+
+# make the shared modules and the corpus construction scripts importable
+repo_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(repo_dir)
+sys.path.append(os.path.join(repo_dir, 'data'))
+
+from construct_four_way_parallel_corpus import construct_multi_language_parallel_corpus
+from convert_to_columnar import convert_corpus_dir
+from synthetic import vocabulary, write_raw_corpus, word_level_tokenizer, tiny_gpt2, tiny_t5
+from common.experiments import commit_hash
+
+# helper function to import a module of one of the pipelines by path, since
+# both of them have a preprocess.py
+def load_module(name, path):
+    spec = importlib.util.spec_from_file_location(name, os.path.join(repo_dir, path))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    return module
+
+perplexity_preprocess = load_module("perplexity_preprocess", "perplexity_delta/preprocess.py")
+perplexity_scoring = load_module("perplexity_scoring", "perplexity_delta/scoring.py")
+perplexity_streaming = load_module("perplexity_streaming", "perplexity_delta/streaming.py")
+translation_preprocess = load_module("translation_preprocess", "context_aware_translation/preprocess.py")
+translation_inference = load_module("translation_inference", "context_aware_translation/inference.py")
+
+benchmarks_dir = os.path.dirname(os.path.abspath(__file__))
+
+params = {
+    # synthetic corpora: sentences per language pair in the raw corpus
+    "CORPUS_SIZES": [1000, 10000, 100000],
+    "LANGUAGE_PAIRS": ["en-ja", "en-es", "en-fr"],
+    "VOCABULARY_SIZE": 1000,
+    "CONTEXT_TYPES": [
+        "no-context-without-break", "no-context-with-break", "2-to-2", "3-to-3",
+        "random-context", "random-context-within-document",
+    ],
+    "BREAK_TOKEN": "<break>",
+
+    # perplexity scoring and translation run on eval examples of the largest corpus
+    "SCORING_EXAMPLES": 500,
+    "SCORING_BATCH_SIZE": 16,
+    "TRANSLATION_SENTENCES": 100,
+    "TRANSLATION_MAX_LENGTH": 32,
+    "TRANSLATION_BEAM_WIDTHS": [1, 4],
+    "TRANSLATION_MAX_TOKENS": 8192,
+
+    # each benchmark reports the fastest of this many runs
+    "REPEATS": 3,
+    "SEED": 0,
+
+    # results go to OUTPUT_DIR/{date}_{commit}.json and are compared against
+    # the baseline; benchmarks more than REGRESSION_THRESHOLD (relative)
+    # slower than the baseline are regressions, and fail the run. with
+    # SAVE_BASELINE the results become the new baseline
+    "OUTPUT_DIR": os.path.join(benchmarks_dir, "results"),
+    "BASELINE_PATH": os.path.join(benchmarks_dir, "baseline.json"),
+    "SAVE_BASELINE": False,
+    "REGRESSION_THRESHOLD": 0.2,
+}
+
+# helper function to time a benchmark: the fastest of several runs (each
+# after an untimed setup, if given), with its throughput in items per second
+def measure(function, items, repeats, setup=None):
+    times = []
+    for _ in range(repeats):
+        if setup is not None:
+            setup()
+
+        start_time = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start_time)
+
+    seconds = min(times)
+    return {"seconds": seconds, "items": items, "items_per_second": items / seconds if seconds > 0 else None}
+
+# helper function to remove a directory if it exists
+def remove_dir(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+
+# corpus construction, columnar conversion and every context type of both
+# preprocess functions on a synthetic corpus of one size; the corpus is
+# built under workspace/data, and the preprocess functions run from
+# workspace/run so their ../data paths resolve to it
+def corpus_benchmarks(workspace, corpus_size, words):
+    results = {}
+    data_dir = os.path.join(workspace, 'data')
+    run_dir = os.path.join(workspace, 'run')
+    os.makedirs(run_dir)
+    corpus = 'four_way_parallel_corpus'
+
+    num_sentences = write_raw_corpus(
+        os.path.join(data_dir, 'raw'), params["LANGUAGE_PAIRS"], corpus_size, words, seed=params["SEED"])
+
+    os.chdir(data_dir)
+    results[f"construct_corpus/{corpus_size}"] = measure(
+        lambda: construct_multi_language_parallel_corpus(params["LANGUAGE_PAIRS"], corpus),
+        num_sentences * len(params["LANGUAGE_PAIRS"]),
+        params["REPEATS"],
+        setup=lambda: remove_dir(corpus),
+    )
+
+    for corpus_format in ('text', 'columnar'):
+        if corpus_format == 'columnar':
+            os.chdir(data_dir)
+            results[f"convert_to_columnar/{corpus_size}"] = measure(
+                lambda: [convert_corpus_dir(params["LANGUAGE_PAIRS"], f'{corpus}/{split}') for split in ('train', 'eval')],
+                num_sentences * len(params["LANGUAGE_PAIRS"]),
+                params["REPEATS"],
+                setup=lambda: [
+                    remove_dir(f'./{corpus}/{split}/{language_pair}/OpenSubtitles.{language_pair}.columnar')
+                    for split in ('train', 'eval') for language_pair in params["LANGUAGE_PAIRS"]
+                ],
+            )
+
+        os.chdir(run_dir)
+        num_lines = len(perplexity_preprocess.preprocess(corpus, 'ja', 'train'))
+        results[f"perplexity_preprocess/{corpus_format}/{corpus_size}"] = measure(
+            lambda: perplexity_preprocess.preprocess(corpus, 'ja', 'train'), num_lines, params["REPEATS"])
+
+        for context_type in params["CONTEXT_TYPES"]:
+            results[f"translation_preprocess/{corpus_format}/{context_type}/{corpus_size}"] = measure(
+                lambda: translation_preprocess.preprocess(
+                    corpus, 'en-ja', 'train', context_type, params["BREAK_TOKEN"], seed=params["SEED"]),
+                num_lines,
+                params["REPEATS"],
+            )
+
+    return results
+
+# perplexity scoring of the same examples one at a time (two forward passes
+# per example, the reference implementation), in batches, packed and
+# streamed through their documents
+def scoring_benchmarks(words):
+    documents = []
+    num_examples = 0
+    for doc_id, sentences in perplexity_preprocess.preprocess_documents('four_way_parallel_corpus', 'ja', 'eval'):
+        if num_examples >= params["SCORING_EXAMPLES"]:
+            break
+        documents.append((doc_id, sentences))
+        num_examples += len(sentences)
+    examples = perplexity_preprocess.document_examples(documents)
+
+    tokenizer = word_level_tokenizer(words)
+    model = tiny_gpt2(len(tokenizer), seed=params["SEED"])
+
+    return {
+        f"perplexity_scoring/{scoring_mode}": measure(function, len(examples), params["REPEATS"])
+        for scoring_mode, function in (
+            ("per_example", lambda: [perplexity_scoring.two_pass_perplexities(model, tokenizer, example) for example in examples]),
+            ("batched", lambda: perplexity_scoring.score_examples(model, tokenizer, examples, params["SCORING_BATCH_SIZE"])),
+            ("packed", lambda: perplexity_scoring.score_examples(
+                model, tokenizer, examples, params["SCORING_BATCH_SIZE"], packed=True)),
+            ("streaming", lambda: perplexity_streaming.score_documents(model, tokenizer, documents)),
+        )
+    }
+
+# translation throughput one sentence at a time and in token-budget batches,
+# for each beam width, with a t5 model wrapped the way simpletransformers'
+# T5Model holds it
+def translation_benchmarks(words):
+    eval_df = translation_preprocess.preprocess(
+        'four_way_parallel_corpus', 'en-ja', 'eval', '2-to-2', params["BREAK_TOKEN"], seed=params["SEED"])
+    source_sentences = eval_df["input_text"].tolist()[:params["TRANSLATION_SENTENCES"]]
+
+    tokenizer = word_level_tokenizer(words, eos_token='</s>')
+    model = SimpleNamespace(
+        model=tiny_t5(len(tokenizer), tokenizer.pad_token_id, tokenizer.eos_token_id, seed=params["SEED"]),
+        tokenizer=tokenizer,
+        device="cpu",
+        args=SimpleNamespace(
+            max_seq_length=128,
+            max_length=params["TRANSLATION_MAX_LENGTH"],
+            num_beams=1,
+            length_penalty=1.0,
+            early_stopping=True,
+            repetition_penalty=1.0,
+        ),
+    )
+
+    results = {}
+    for num_beams in params["TRANSLATION_BEAM_WIDTHS"]:
+        for batching, max_batch_size in (("per_sentence", 1), ("batched", None)):
+            results[f"translation/{batching}/beams_{num_beams}"] = measure(
+                lambda: translation_inference.translate(
+                    model, source_sentences, params["TRANSLATION_MAX_TOKENS"], max_batch_size, num_beams),
+                len(source_sentences),
+                params["REPEATS"],
+            )
+
+    return results
+
+# compare results against a baseline: the relative change in the seconds of
+# every benchmark both have, flagging those slower by more than the threshold
+def compare_to_baseline(results, baseline, threshold):
+    comparison = {}
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+
+        change = result["seconds"] / baseline[name]["seconds"] - 1 if baseline[name]["seconds"] > 0 else 0.0
+        comparison[name] = {
+            "baseline_seconds": baseline[name]["seconds"],
+            "seconds": result["seconds"],
+            "relative_change": change,
+            "regression": change > threshold,
+        }
+
+    return comparison
+
+# helper function to print results (and their comparison to the baseline) as a table
+def print_table(results, comparison):
+    print(f"{'benchmark':<70} {'seconds':>10} {'items/s':>12} {'baseline':>10} {'change':>8}")
+    for name, result in results.items():
+        row = f"{name:<70} {result['seconds']:>10.4f} {result['items_per_second'] or 0:>12.1f}"
+        if name in comparison:
+            row += f" {comparison[name]['baseline_seconds']:>10.4f} {100 * comparison[name]['relative_change']:>7.1f}%"
+            if comparison[name]["regression"]:
+                row += "  REGRESSION"
+        print(row)
+
+
+if __name__ == "__main__":
+    commit = commit_hash()
+    words = vocabulary(params["VOCABULARY_SIZE"])
+    original_dir = os.getcwd()
+
+    results = {}
+    workspace_root = tempfile.mkdtemp(prefix="benchmarks_")
+    try:
+        for corpus_size in params["CORPUS_SIZES"]:
+            workspace = os.path.join(workspace_root, str(corpus_size))
+            results.update(corpus_benchmarks(workspace, corpus_size, words))
+
+        # the workspace of the largest corpus is still the working directory
+        results.update(scoring_benchmarks(words))
+        results.update(translation_benchmarks(words))
+    finally:
+        os.chdir(original_dir)
+        shutil.rmtree(workspace_root)
+
+    baseline = None
+    if os.path.isfile(params["BASELINE_PATH"]):
+        with open(params["BASELINE_PATH"], "r") as f:
+            baseline = json.load(f)
+    comparison = compare_to_baseline(results, baseline["results"], params["REGRESSION_THRESHOLD"]) \
+        if baseline is not None else {}
+
+    report = {
+        "commit": commit,
+        "date": datetime.now().isoformat(),
+        "platform": platform.platform(),
+        "python_version": platform.python_version(),
+        "torch_version": torch.__version__,
+        "torch_threads": torch.get_num_threads(),
+        "params": {param: value for param, value in params.items() if param not in ("OUTPUT_DIR", "BASELINE_PATH")},
+        "results": results,
+        "baseline_commit": baseline["commit"] if baseline is not None else None,
+        "comparison": comparison,
+    }
+
+    os.makedirs(params["OUTPUT_DIR"], exist_ok=True)
+    output_path = os.path.join(params["OUTPUT_DIR"], datetime.now().strftime("%Y%m%d_%H%M") + "_" + commit + ".json")
+    with open(output_path, "w") as f:
+        json.dump(report, f, indent=4)
+
+    print_table(results, comparison)
+    print(f"Results saved to {output_path}")
+
+    if params["SAVE_BASELINE"]:
+        with open(params["BASELINE_PATH"], "w") as f:
+            json.dump(report, f, indent=4)
+        print(f"Saved as the baseline ({params['BASELINE_PATH']})")
+    elif baseline is None:
+        print("No baseline to compare against (set SAVE_BASELINE to store one)")
+
+    regressions = [name for name, change in comparison.items() if change["regression"]]
+    if regressions and not params["SAVE_BASELINE"]:
+        print(f"{len(regressions)} benchmarks regressed by more than {100 * params['REGRESSION_THRESHOLD']:g}% "
+              f"against the baseline (commit {baseline['commit']})")
+        sys.exit(1)
@@ -0,0 +1,72 @@
+import os
+import random
+
+# synthetic inputs for the benchmarks, so they run offline: raw corpora in
+# the OpenSubtitles layout (an .ids file plus one file per language, one
+# aligned sentence per line), a word-level tokenizer over the synthetic
+# vocabulary and tiny randomly initialised gpt2 / t5 models
+
+# helper function to build the synthetic vocabulary
+def vocabulary(size=1000):
+    return [f'w{i}' for i in range(size)]
+
+# write a raw parallel corpus of about num_sentences sentences per language
+# pair to {root}/{language_pair}/OpenSubtitles.{language_pair}.{file_type};
+# every language pair gets the same english documents (with its own
+# sentences), so they survive construct_multi_language_parallel_corpus
+def write_raw_corpus(root, language_pairs, num_sentences, words, seed=0, mean_document_length=20):
+    rng = random.Random(seed)
+    num_documents = max(num_sentences // mean_document_length, 2)
+    document_lengths = [rng.randint(1, 2 * mean_document_length - 1) for _ in range(num_documents)]
+
+    for language_pair in language_pairs:
+        lang_1, lang_2 = language_pair.split('-')
+        pair_dir = os.path.join(root, language_pair)
+        os.makedirs(pair_dir, exist_ok=True)
+
+        with open(os.path.join(pair_dir, f'OpenSubtitles.{language_pair}.ids'), 'w') as id_file, \
+             open(os.path.join(pair_dir, f'OpenSubtitles.{language_pair}.{lang_1}'), 'w') as lang_1_file, \
+             open(os.path.join(pair_dir, f'OpenSubtitles.{language_pair}.{lang_2}'), 'w') as lang_2_file:
+            for doc, document_length in enumerate(document_lengths):
+                for line in range(document_length):
+                    id_file.write(f'{lang_1}/2000/{doc}/{doc}.xml.gz {lang_2}/2000/{doc}/{doc}.xml.gz {line} {line}\n')
+                    lang_1_file.write(' '.join(rng.choice(words) for _ in range(rng.randint(1, 15))) + '\n')
+                    lang_2_file.write(' '.join(rng.choice(words) for _ in range(rng.randint(1, 15))) + '\n')
+
+    return sum(document_lengths)
+
+# word-level tokenizer over the synthetic vocabulary; with eos_token, every
+# encoding ends with it (like the t5 tokenizers)
+def word_level_tokenizer(words, eos_token=None):
+    from tokenizers import Tokenizer, models, pre_tokenizers, processors
+    from transformers import PreTrainedTokenizerFast
+
+    special_tokens = ['<pad>', '<unk>'] + ([eos_token] if eos_token is not None else [])
+    tokenizer = Tokenizer(models.WordLevel({token: i for i, token in enumerate(special_tokens + words)}, unk_token='<unk>'))
+    tokenizer.pre_tokenizer = pre_tokenizers.Whitespace()
+    if eos_token is not None:
+        tokenizer.post_processor = processors.TemplateProcessing(
+            single=f'$A {eos_token}', special_tokens=[(eos_token, special_tokens.index(eos_token))])
+
+    return PreTrainedTokenizerFast(tokenizer_object=tokenizer, pad_token='<pad>', unk_token='<unk>', eos_token=eos_token)
+
+# tiny randomly initialised gpt2 language model
+def tiny_gpt2(vocab_size, seed=0):
+    import torch
+    from transformers import GPT2Config, GPT2LMHeadModel
+
+    torch.manual_seed(seed)
+    config = GPT2Config(vocab_size=vocab_size, n_positions=512, n_embd=64, n_layer=2, n_head=2)
+
+    return GPT2LMHeadModel(config).eval()
+
+# tiny randomly initialised t5 translation model
+def tiny_t5(vocab_size, pad_token_id, eos_token_id, seed=0):
+    import torch
+    from transformers import T5Config, T5ForConditionalGeneration
+
+    torch.manual_seed(seed)
+    config = T5Config(vocab_size=vocab_size, d_model=64, d_ff=128, d_kv=16, num_layers=2, num_heads=2,
+                      decoder_start_token_id=pad_token_id, pad_token_id=pad_token_id, eos_token_id=eos_token_id)
+
+    return T5ForConditionalGeneration(config).eval()
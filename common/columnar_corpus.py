@@ -0,0 +1,155 @@
+import json
+import mmap
+import os
+from array import array
+
+import numpy as np
+
+# a parallel corpus (two language files plus an .ids file, one line each per
+# aligned sentence pair) converted to a compact binary, columnar format:
+#
+#   {lang}.utf8          the stripped lines of a language, concatenated
+#   {lang}.offsets.npy   int64 byte offsets; line i is utf8[offsets[i]:offsets[i + 1]]
+#   doc_ids.npy          int32 index into doc_names.json of each line's doc id
+#   doc_names.json       the distinct doc ids, in order of first appearance
+#   doc_offsets.npy      int64 line index at which each document starts, plus
+#                        the number of lines; a document is a run of lines
+#                        sharing a doc id
+#   meta.json            languages and number of lines
+#
+# everything is memory-mapped by the reader, so lines are only decoded
+# (and only paged in) when they are actually used
+
+# helper function to read a doc id from an .ids line (the first language's document)
+def doc_id_from_line(line):
+    return line.split()[0]
+
+# helper function to check whether a columnar corpus exists and is at least
+# as new as the text files it was converted from; text files rewritten
+# since (e.g. by construct_four_way_parallel_corpus.py) make it stale
+def columnar_up_to_date(columnar_path, text_paths):
+    if not os.path.isdir(columnar_path):
+        return False
+
+    text_mtimes = [os.path.getmtime(text_path) for text_path in text_paths if os.path.exists(text_path)]
+    return os.path.getmtime(columnar_path) >= max(text_mtimes, default=0)
+
+# convert a (lang_1, lang_2, ids) triple of text files into columnar format;
+# the files are streamed line by line, never loaded whole
+def convert_corpus(lang_1_path, lang_2_path, ids_path, output_path, languages):
+    lang_1, lang_2 = languages
+    tmp_path = output_path + '.tmp'
+    os.makedirs(tmp_path, exist_ok=True)
+
+    offsets = {lang_1: array('q', [0]), lang_2: array('q', [0])}
+    doc_ids = array('i')
+    doc_offsets = array('q')
+    doc_names = []
+    doc_name_indices = {}
+
+    with open(lang_1_path, 'r') as lang_1_corpus, \
+         open(lang_2_path, 'r') as lang_2_corpus, \
+         open(ids_path, 'r') as id_file, \
+         open(os.path.join(tmp_path, f'{lang_1}.utf8'), 'wb') as lang_1_blob, \
+         open(os.path.join(tmp_path, f'{lang_2}.utf8'), 'wb') as lang_2_blob:
+        prev_doc_id = None
+        for i, (raw_lang_1_line, raw_lang_2_line, id_line) in enumerate(zip(lang_1_corpus, lang_2_corpus, id_file)):
+            for language, raw_line, blob in ((lang_1, raw_lang_1_line, lang_1_blob), (lang_2, raw_lang_2_line, lang_2_blob)):
+                encoded_line = raw_line.strip().encode('utf-8')
+                blob.write(encoded_line)
+                offsets[language].append(offsets[language][-1] + len(encoded_line))
+
+            doc_id = doc_id_from_line(id_line)
+            if doc_id not in doc_name_indices:
+                doc_name_indices[doc_id] = len(doc_names)
+                doc_names.append(doc_id)
+            doc_ids.append(doc_name_indices[doc_id])
+
+            if doc_id != prev_doc_id:
+                doc_offsets.append(i)
+            prev_doc_id = doc_id
+
+    num_lines = len(doc_ids)
+    doc_offsets.append(num_lines)
+
+    for language in languages:
+        np.save(os.path.join(tmp_path, f'{language}.offsets.npy'), np.frombuffer(offsets[language], dtype=np.int64))
+    np.save(os.path.join(tmp_path, 'doc_ids.npy'), np.frombuffer(doc_ids, dtype=np.int32))
+    np.save(os.path.join(tmp_path, 'doc_offsets.npy'), np.frombuffer(doc_offsets, dtype=np.int64))
+    with open(os.path.join(tmp_path, 'doc_names.json'), 'w') as f:
+        json.dump(doc_names, f)
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump({"languages": list(languages), "lines": num_lines}, f, indent=4)
+
+    os.rename(tmp_path, output_path)
+
+# the lines of one language of a columnar corpus, as a lazy sequence:
+# supports len(), indexing, slicing and iteration, decoding lines on access
+class LineColumn:
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+
+        return self.blob[self.offsets[i]:self.offsets[i + 1]].decode('utf-8')
+
+    def __iter__(self):
+        # read offsets in chunks to avoid per-line numpy indexing overhead
+        chunk_size = 1 << 16
+        for chunk_start in range(0, len(self), chunk_size):
+            chunk_offsets = self.offsets[chunk_start:chunk_start + chunk_size + 1].tolist()
+            for start, end in zip(chunk_offsets[:-1], chunk_offsets[1:]):
+                yield self.blob[start:end].decode('utf-8')
+
+# reader for a corpus written by convert_corpus
+class ColumnarCorpus:
+    def __init__(self, path):
+        self.path = path
+
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        self.languages = meta["languages"]
+        self.num_lines = meta["lines"]
+
+        self.doc_ids = np.load(os.path.join(path, 'doc_ids.npy'), mmap_mode='r')
+        self.doc_offsets = np.load(os.path.join(path, 'doc_offsets.npy'), mmap_mode='r')
+        with open(os.path.join(path, 'doc_names.json'), 'r') as f:
+            self.doc_names = json.load(f)
+
+        self.columns = {}
+        for language in self.languages:
+            with open(os.path.join(path, f'{language}.utf8'), 'rb') as f:
+                # mmap can't map empty files
+                blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size > 0 else b''
+            offsets = np.load(os.path.join(path, f'{language}.offsets.npy'), mmap_mode='r')
+            self.columns[language] = LineColumn(blob, offsets)
+
+    def __len__(self):
+        return self.num_lines
+
+    def column(self, language):
+        return self.columns[language]
+
+    def doc_id(self, i):
+        return self.doc_names[self.doc_ids[i]]
+
+    # iterate over the doc id of every line, in order
+    def iter_doc_ids(self):
+        for doc_id, start, end in self.documents():
+            for _ in range(start, end):
+                yield doc_id
+
+    # iterate over documents as (doc id, first line, end line) triples
+    def documents(self):
+        starts = self.doc_offsets[:-1].tolist()
+        ends = self.doc_offsets[1:].tolist()
+        for doc_index, start, end in zip(self.doc_ids[self.doc_offsets[:-1]].tolist(), starts, ends):
+            yield self.doc_names[doc_index], start, end
@@ -0,0 +1,138 @@
+import random
+import re
+
+import numpy as np
+
+# context construction on array-backed corpora. a corpus is a sequence of
+# lines plus a boolean mask of the lines that start a document; the
+# context of every line is described by an (n, k) array of line indices
+# (-1 where there is no context sentence), computed with vectorized
+# operations. strings are only built when an example is accessed, so the
+# lines can stay in memory-mapped columns until the model needs them
+#
+#   no-context-without-break   k = 0:  {line}
+#   no-context-with-break      k = 1:  ' {break} {line}' (context always empty)
+#   2-to-2, N-to-N             k = N - 1 previous sentences of the same
+#                              document: '{c_1} {break} ... {c_k} {break} {line}'
+#   random-context             k = 1 random sentence from anywhere in the corpus
+#   random-context-within-document
+#                              k = 1 random other sentence of the same document
+
+# helper function to compute the document-start mask from per-line doc ids
+def document_starts(doc_ids):
+    doc_ids = np.asarray(doc_ids)
+    starts = np.ones(len(doc_ids), dtype=bool)
+    starts[1:] = doc_ids[1:] != doc_ids[:-1]
+
+    return starts
+
+# helper function to find the first line and end line of every line's document
+def document_bounds(starts):
+    line_indices = np.arange(len(starts))
+    first_lines = np.maximum.accumulate(np.where(starts, line_indices, 0))
+
+    # the end of a document is the start of the next one
+    next_starts = np.append(np.flatnonzero(starts), len(starts))
+    end_lines = next_starts[np.cumsum(starts)] if len(starts) > 0 else np.zeros(0, dtype=np.int64)
+
+    return first_lines, end_lines
+
+# indices of the k previous sentences of every line within its document,
+# oldest first; -1 before the start of the document
+def previous_sentence_windows(starts, k):
+    line_indices = np.arange(len(starts))
+    first_lines, _ = document_bounds(starts)
+
+    windows = line_indices[:, None] - np.arange(k, 0, -1)[None, :]
+    windows[windows < first_lines[:, None]] = -1
+
+    return windows
+
+# index of one random context sentence for every line, as an (n, 1) array.
+# across documents, the sentences are those of random.Random(seed).randint,
+# so seeded random-context examples match the original preprocessing; within
+# a document, any other sentence of the line's document is drawn (-1 for
+# single-sentence documents)
+def random_context_indices(starts, seed=None, within_document=False):
+    num_lines = len(starts)
+    if not within_document:
+        rng = random.Random(seed)
+        return np.array([rng.randint(0, num_lines - 1) for _ in range(num_lines)], dtype=np.int64).reshape(-1, 1)
+
+    rng = np.random.default_rng(seed)
+    line_indices = np.arange(num_lines)
+    first_lines, end_lines = document_bounds(starts)
+    other_lines = end_lines - first_lines - 1
+
+    # draw among the other lines of the document, skipping over the line itself
+    offsets = np.floor(rng.random(num_lines) * np.maximum(other_lines, 1)).astype(np.int64)
+    indices = first_lines + offsets
+    indices[indices >= line_indices] += 1
+    indices[other_lines == 0] = -1
+
+    return indices.reshape(-1, 1)
+
+# helper function to parse an N-to-N context type into its number of context sentences
+def window_size(context_type):
+    match = re.fullmatch(r'(\d+)-to-\1', context_type)
+    return int(match.group(1)) - 1 if match is not None else None
+
+# helper function to describe a context type that only looks back within
+# the document as (context slots, previous sentences kept, with break), so
+# its examples can be built in one sequential pass with a trailing window;
+# None for the random context types, which need random access
+def context_slots(context_type):
+    if context_type == 'no-context-without-break':
+        return 0, 0, False
+    elif context_type == 'no-context-with-break':
+        return 1, 0, True
+    elif window_size(context_type) is not None:
+        return window_size(context_type), window_size(context_type), True
+    else:
+        return None
+
+# context indices of every line for a context type (see above), along with
+# whether examples join sentences with the break token
+def context_indices(context_type, starts, seed=None):
+    if context_type == 'no-context-without-break':
+        return np.zeros((len(starts), 0), dtype=np.int64), False
+    elif context_type == 'no-context-with-break':
+        return np.full((len(starts), 1), -1, dtype=np.int64), True
+    elif context_type == 'random-context':
+        return random_context_indices(starts, seed), True
+    elif context_type == 'random-context-within-document':
+        return random_context_indices(starts, seed, within_document=True), True
+    elif window_size(context_type) is not None:
+        return previous_sentence_windows(starts, window_size(context_type)), True
+    else:
+        raise NotImplementedError
+
+# lazy sequence of (prefix, input_text, target_text) examples: example i
+# is line i of the source and target columns with its context sentences
+# (the lines at indices[i], empty where -1), rendered on access
+class ContextExamples:
+    def __init__(self, source_lines, target_lines, indices, break_token=None):
+        self.source_lines = source_lines
+        self.target_lines = target_lines
+        self.indices = indices
+        self.break_token = break_token
+
+    def __len__(self):
+        return len(self.indices)
+
+    # helper function to join a line of a column with its context sentences
+    def render(self, lines, i):
+        if self.break_token is None:
+            return lines[i]
+
+        sentences = [lines[j] if j >= 0 else '' for j in self.indices[i].tolist()]
+        sentences.append(lines[i])
+
+        return f' {self.break_token} '.join(sentences)
+
+    def __getitem__(self, i):
+        return ["", self.render(self.source_lines, i), self.render(self.target_lines, i)]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
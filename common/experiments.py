@@ -0,0 +1,181 @@
+import hashlib
+import json
+import os
+import sqlite3
+import subprocess
+from datetime import datetime
+
+from common.model_registry import resolve
+
+# every run of a script gets an experiment directory experiments/{date}_{commit}
+# holding its params.json (and results.json once it finishes). runs are
+# identified by a hash of their params plus fingerprints of the data and
+# model they use, so a configuration that already completed is never run
+# again. experiments/index.sqlite3 indexes every run of a script, with its
+# params and metrics stored as JSON, e.g.
+#
+#   SELECT experiment_dir, json_extract(metrics, '$.AVERAGE_PERPLEXITY_DELTA')
+#   FROM runs WHERE json_extract(params, '$.LANGUAGE') = 'ja'
+
+# helper function to identify a version of a file by its size and
+# modification time, without reading it (corpora are far too big to hash
+# on every start)
+def file_signature(path):
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+# helper function to fingerprint the model a run starts from: its name
+# plus, if it resolves to a local snapshot or checkpoint directory, the
+# signatures of the files in it (config, weights, tokenizer, ...)
+def model_fingerprint(model):
+    path = resolve(model) if model is not None else None
+    if path is None or not os.path.isdir(path):
+        return model
+
+    return {
+        "name": model,
+        "files": {
+            file_name: file_signature(os.path.join(path, file_name))
+            for file_name in sorted(os.listdir(path))
+            if os.path.isfile(os.path.join(path, file_name))
+        },
+    }
+
+# helper function to fingerprint the inputs of a run: the versions of its
+# data files and of the model it starts from
+def experiment_fingerprint(data_files=(), model=None):
+    return {
+        "data": {path: file_signature(path) for path in data_files},
+        "model": model_fingerprint(model),
+    }
+
+# helper function to hash a run's configuration
+def run_hash(params, fingerprint=None):
+    return hashlib.sha256(json.dumps(
+        {"params": params, "fingerprint": fingerprint}, sort_keys=True).encode('utf-8')).hexdigest()
+
+# helper function to get the short hash of the checked out commit
+def commit_hash():
+    return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"]).strip().decode("utf-8")
+
+# SQLite index of the runs in an experiments directory
+class ExperimentIndex:
+    def __init__(self, experiments_dir="experiments"):
+        self.experiments_dir = experiments_dir
+        os.makedirs(experiments_dir, exist_ok=True)
+
+        self.connection = sqlite3.connect(os.path.join(experiments_dir, "index.sqlite3"))
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS runs (experiment_dir TEXT PRIMARY KEY, hash TEXT, commit_hash TEXT, "
+            "started TEXT, status TEXT, params TEXT, metrics TEXT)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS runs_hash ON runs (hash)")
+        self.connection.commit()
+
+    # runs with a given hash, most recent first, as (experiment dir, status) pairs
+    def find(self, config_hash):
+        return self.connection.execute(
+            "SELECT experiment_dir, status FROM runs WHERE hash = ? ORDER BY started DESC", (config_hash,)).fetchall()
+
+    def add(self, experiment_dir, config_hash, commit, params, status="running"):
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?, ?, NULL)",
+                (experiment_dir, config_hash, commit, datetime.now().isoformat(), status, json.dumps(params)),
+            )
+
+    def complete(self, experiment_dir, metrics=None):
+        with self.connection:
+            self.connection.execute(
+                "UPDATE runs SET status = 'completed', metrics = ? WHERE experiment_dir = ?",
+                (json.dumps(metrics) if metrics is not None else None, experiment_dir),
+            )
+
+    # all indexed runs (optionally only those with a given status) as dicts
+    def runs(self, status=None):
+        query = "SELECT experiment_dir, hash, commit_hash, started, status, params, metrics FROM runs"
+        rows = self.connection.execute(
+            query + " WHERE status = ? ORDER BY started" if status is not None else query + " ORDER BY started",
+            (status,) if status is not None else (),
+        ).fetchall()
+
+        return [
+            {
+                "experiment_dir": experiment_dir,
+                "hash": config_hash,
+                "commit": commit,
+                "started": started,
+                "status": status,
+                "params": json.loads(params) if params is not None else None,
+                "metrics": json.loads(metrics) if metrics is not None else None,
+            }
+            for experiment_dir, config_hash, commit, started, status, params, metrics in rows
+        ]
+
+    # add experiment directories made before the index existed (or by hand);
+    # their fingerprints are unknown, so they are indexed for querying only
+    def scan(self):
+        indexed = {run["experiment_dir"] for run in self.runs()}
+        for name in sorted(os.listdir(self.experiments_dir)):
+            experiment_dir = os.path.join(self.experiments_dir, name)
+            params_path = os.path.join(experiment_dir, "params.json")
+            if experiment_dir in indexed or not os.path.isfile(params_path):
+                continue
+
+            with open(params_path, "r") as f:
+                params = json.load(f)
+            self.add(experiment_dir, None, name.split("_")[2] if name.count("_") >= 2 else None, params, "unknown")
+
+            results_path = os.path.join(experiment_dir, "results.json")
+            if os.path.isfile(results_path):
+                with open(results_path, "r") as f:
+                    self.complete(experiment_dir, json.load(f))
+
+    def close(self):
+        self.connection.close()
+
+# set up the experiment directory of a run (with params.json and any
+# subdirectories) and index it. if a run with the same params and
+# fingerprint already completed, nothing is made and its directory is
+# returned with status "completed"; with resume_incomplete, the directory
+# of an unfinished run with the same hash is returned with status "resumed".
+# otherwise a new directory is made, with status "new". name_suffix is
+# appended to the directory name (e.g. to tell apart runs started together)
+def start_experiment(params, fingerprint=None, experiments_dir="experiments", subdirs=("logs",),
+                     resume_incomplete=False, name_suffix=""):
+    index = ExperimentIndex(experiments_dir)
+    config_hash = run_hash(params, fingerprint)
+
+    try:
+        index.scan()
+        for experiment_dir, status in index.find(config_hash):
+            if status == "completed":
+                return experiment_dir, "completed"
+            if resume_incomplete and os.path.isdir(experiment_dir):
+                return experiment_dir, "resumed"
+
+        # make experiment directory and save experiment params down
+        date_string = datetime.now().strftime("%Y%m%d_%H%M")
+        commit_string = commit_hash()
+        experiment_dir = os.path.join(experiments_dir, date_string + "_" + commit_string + name_suffix)
+        os.mkdir(experiment_dir)
+        for subdir in subdirs:
+            os.mkdir(os.path.join(experiment_dir, subdir))
+
+        with open(os.path.join(experiment_dir, "params.json"), "w") as f:
+            json.dump(params, f, indent=4)
+
+        index.add(experiment_dir, config_hash, commit_string, params)
+    finally:
+        index.close()
+
+    return experiment_dir, "new"
+
+# save a run's results (if any) to results.json and mark it completed in the index
+def finish_experiment(experiment_dir, results=None, experiments_dir="experiments"):
+    if results is not None:
+        with open(os.path.join(experiment_dir, "results.json"), "w") as f:
+            json.dump(results, f, indent=4)
+
+    index = ExperimentIndex(experiments_dir)
+    index.complete(experiment_dir, results)
+    index.close()
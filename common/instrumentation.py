@@ -0,0 +1,187 @@
+import cProfile
+import functools
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    # not available on windows; peak rss isn't recorded there
+    resource = None
+
+# lightweight instrumentation of the pipeline stages, off by default. with
+# INSTRUMENT=1 in the environment (or after enable()) every stage records
+# its calls, wall time, examples and tokens processed and the peak RSS of
+# the process (and of its largest finished subprocess, e.g. a pool worker)
+# when it finished. with INSTRUMENT_PROFILER=cprofile (or
+# torch) the run is also profiled with cProfile (or torch.profiler).
+# finish_run() writes instrumentation.json and the profile (profile.pstats,
+# or trace.json for chrome://tracing) to the run's output directory, next
+# to its params.json, and prints a summary table
+state = {
+    "enabled": os.environ.get("INSTRUMENT", "") not in ("", "0"),
+    "profiler_name": os.environ.get("INSTRUMENT_PROFILER") or None,
+    "stages": {},
+    "output_dir": None,
+    "profiler": None,
+}
+
+# switch instrumentation on (and pick a profiler, "cprofile" or "torch")
+def enable(profiler=None):
+    state["enabled"] = True
+    if profiler is not None:
+        state["profiler_name"] = profiler
+
+def enabled():
+    return state["enabled"]
+
+# helper function to get the peak resident set size of the process in MB;
+# with children=True, that of the largest subprocess that has finished (and
+# been waited for) instead
+def peak_rss_mb(children=False):
+    if resource is None:
+        return None
+
+    peak_rss = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return peak_rss / 2**20 if sys.platform == "darwin" else peak_rss / 2**10
+
+# counts of what a span processed, added to as the stage goes
+class Span:
+    def __init__(self, name):
+        self.name = name
+        self.examples = 0
+        self.tokens = 0
+
+    def add(self, examples=0, tokens=0):
+        self.examples += examples
+        self.tokens += tokens
+
+# time a stage of the pipeline (stages of the same name are accumulated);
+# yields a Span to count the examples and tokens processed with
+@contextmanager
+def span(name, examples=0, tokens=0):
+    record = Span(name)
+    record.add(examples, tokens)
+    if not state["enabled"]:
+        yield record
+        return
+
+    # mark the stage in torch profiler traces too
+    record_function = None
+    if state["profiler"] is not None and state["profiler_name"] == "torch":
+        import torch
+        record_function = torch.profiler.record_function(name)
+        record_function.__enter__()
+
+    start_time = time.perf_counter()
+    try:
+        yield record
+    finally:
+        seconds = time.perf_counter() - start_time
+        if record_function is not None:
+            record_function.__exit__(None, None, None)
+
+        stage = state["stages"].setdefault(name, {"calls": 0, "seconds": 0.0, "examples": 0, "tokens": 0})
+        stage["calls"] += 1
+        stage["seconds"] += seconds
+        stage["examples"] += record.examples
+        stage["tokens"] += record.tokens
+        stage["peak_rss_mb"] = peak_rss_mb()
+        stage["peak_children_rss_mb"] = peak_rss_mb(children=True)
+
+# decorator recording every call of a function as a stage; count and
+# count_tokens (if given) compute the number of examples and tokens
+# processed from the function's result
+def instrumented(name, count=None, count_tokens=None):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not state["enabled"]:
+                return function(*args, **kwargs)
+
+            with span(name) as record:
+                result = function(*args, **kwargs)
+                if count is not None:
+                    record.add(examples=count(result))
+                if count_tokens is not None:
+                    record.add(tokens=count_tokens(result))
+
+            return result
+
+        return wrapper
+
+    return decorator
+
+# start instrumenting a run whose outputs go to output_dir (and its
+# profiler, if one was picked)
+def start_run(output_dir=None):
+    if not state["enabled"]:
+        return
+
+    state["output_dir"] = output_dir
+    if state["profiler_name"] == "cprofile":
+        state["profiler"] = cProfile.Profile()
+        state["profiler"].enable()
+    elif state["profiler_name"] == "torch":
+        import torch
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        state["profiler"] = torch.profiler.profile(activities=activities)
+        state["profiler"].start()
+    elif state["profiler_name"] is not None:
+        raise ValueError(f'unknown profiler {state["profiler_name"]} (use "cprofile" or "torch")')
+
+# helper function to format the recorded stages as a table
+def summary_table():
+    rows = [f"{'stage':<40} {'calls':>6} {'seconds':>10} {'examples':>10} {'examples/s':>11} "
+            f"{'tokens':>11} {'tokens/s':>11} {'peak rss MB':>12} {'children MB':>12}"]
+    for name, stage in state["stages"].items():
+        seconds = stage["seconds"]
+        rows.append(
+            f"{name:<40} {stage['calls']:>6} {seconds:>10.2f} {stage['examples']:>10} "
+            f"{stage['examples'] / seconds if seconds > 0 else 0:>11.1f} {stage['tokens']:>11} "
+            f"{stage['tokens'] / seconds if seconds > 0 else 0:>11.1f} "
+            f"{stage['peak_rss_mb'] if stage['peak_rss_mb'] is not None else float('nan'):>12.1f} "
+            f"{stage['peak_children_rss_mb'] if stage['peak_children_rss_mb'] is not None else float('nan'):>12.1f}"
+        )
+
+    return "\n".join(rows)
+
+# stop the profiler, save the stages (and profile) to the output directory
+# and print the summary table; output_dirs (if given) replaces the output
+# directory given to start_run, for runs whose outputs are only known once
+# they're set up or are spread over several directories
+def finish_run(output_dirs=None):
+    if not state["enabled"]:
+        return
+
+    if output_dirs is None:
+        output_dirs = [state["output_dir"]] if state["output_dir"] is not None else []
+
+    profile_path = None
+    if state["profiler"] is not None:
+        if state["profiler_name"] == "cprofile":
+            state["profiler"].disable()
+            profile_path = "profile.pstats"
+            for output_dir in output_dirs:
+                state["profiler"].dump_stats(os.path.join(output_dir, profile_path))
+        else:
+            state["profiler"].stop()
+            profile_path = "trace.json"
+            for output_dir in output_dirs:
+                state["profiler"].export_chrome_trace(os.path.join(output_dir, profile_path))
+        state["profiler"] = None
+
+    for output_dir in output_dirs:
+        with open(os.path.join(output_dir, "instrumentation.json"), "w") as f:
+            json.dump({"stages": state["stages"], "profile": profile_path}, f, indent=4)
+
+    print(summary_table())
+    if output_dirs:
+        print(f"Instrumentation saved to {', '.join(output_dirs)}" +
+              (f" (profile: {profile_path})" if profile_path else ""))
@@ -0,0 +1,167 @@
+import importlib
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager, nullcontext
+
+# every pre-trained model the repo uses, with the tokenizer and model
+# classes to load it with (names in transformers, imported only when a
+# model is loaded) and any attributes to set on its tokenizer
+MODELS = {
+    "gpt2-medium": {
+        "tokenizer": "GPT2TokenizerFast",
+        "model": "GPT2LMHeadModel",
+    },
+    "rinna/japanese-gpt2-medium": {
+        "tokenizer": "T5TokenizerFast",
+        "model": "AutoModelForCausalLM",
+        # due to some bug of tokenizer config loading
+        "tokenizer_attributes": {"do_lower_case": True},
+    },
+    "DeepESP/gpt2-spanish-medium": {
+        "tokenizer": "AutoTokenizer",
+        "model": "AutoModelForCausalLM",
+    },
+    "antoiloui/belgpt2": {
+        "tokenizer": "AutoTokenizer",
+        "model": "AutoModelForCausalLM",
+    },
+    "google/mt5-base": {
+        "tokenizer": "AutoTokenizer",
+        "model": "MT5ForConditionalGeneration",
+    },
+}
+
+# local snapshots of the models live at the top level of the repo, next to
+# the token cache, so nodes without network access can load them; make them
+# with `python -m common.model_registry` on a node with network access
+SNAPSHOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cache', 'models')
+
+# records how long each phase of starting up (imports, loading the
+# tokenizer, loading weights, ...) takes
+class StartupTimer:
+    def __init__(self):
+        self.phases = {}
+
+    @contextmanager
+    def phase(self, name):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - start_time
+
+    def report(self, file=sys.stdout):
+        for name, seconds in self.phases.items():
+            print(f"{name:<30} {seconds:8.2f}s", file=file)
+        print(f"{'total':<30} {sum(self.phases.values()):8.2f}s", file=file)
+
+# helper function to get a transformers class by name, importing transformers lazily
+def transformers_class(class_name):
+    return getattr(importlib.import_module("transformers"), class_name)
+
+# helper function to find the directory of a model's local snapshot
+def snapshot_path(model_name, snapshot_dir=SNAPSHOT_DIR):
+    return os.path.join(snapshot_dir, model_name.replace('/', '--'))
+
+# helper function to resolve a model name to its local snapshot if there
+# is one (and otherwise to the name itself, to load from the hub)
+def resolve(model_name, snapshot_dir=SNAPSHOT_DIR):
+    path = snapshot_path(model_name, snapshot_dir)
+    return path if os.path.isfile(os.path.join(path, "snapshot.json")) else model_name
+
+# helper function to time a phase on a timer, if there is one
+def timed(timer, name):
+    return timer.phase(name) if timer is not None else nullcontext()
+
+def load_tokenizer(model_name, timer=None, snapshot_dir=SNAPSHOT_DIR):
+    spec = MODELS.get(model_name, {"tokenizer": "AutoTokenizer"})
+
+    with timed(timer, "import transformers"):
+        tokenizer_class = transformers_class(spec["tokenizer"])
+    with timed(timer, f"load tokenizer {model_name}"):
+        tokenizer = tokenizer_class.from_pretrained(resolve(model_name, snapshot_dir))
+        for attribute, value in spec.get("tokenizer_attributes", {}).items():
+            setattr(tokenizer, attribute, value)
+
+    return tokenizer
+
+# helper function to check whether the installed transformers loads
+# model.safetensors itself (memory-mapped, straight into the model)
+def loads_safetensors():
+    return hasattr(importlib.import_module("transformers.utils"), "SAFE_WEIGHTS_NAME")
+
+# load a registered model, from its local snapshot if there is one. where
+# transformers supports it, snapshot weights are memory-mapped from
+# model.safetensors into an uninitialised model (low_cpu_mem_usage).
+# older versions get the safetensors weights as a state dict instead: that
+# skips unpickling, but every weight is read and copied into a freshly
+# initialised model
+def load_model(model_name, device="cpu", timer=None, snapshot_dir=SNAPSHOT_DIR):
+    spec = MODELS.get(model_name, {"model": "AutoModelForCausalLM"})
+    path = resolve(model_name, snapshot_dir)
+    weights_path = os.path.join(path, "model.safetensors")
+
+    with timed(timer, "import transformers"):
+        model_class = transformers_class(spec["model"])
+    with timed(timer, f"load weights {model_name}"):
+        try:
+            from safetensors.torch import load_file
+        except ImportError:
+            load_file = None
+
+        if os.path.isfile(weights_path) and loads_safetensors():
+            model = model_class.from_pretrained(path, low_cpu_mem_usage=True)
+        elif os.path.isfile(weights_path) and load_file is not None:
+            config = transformers_class("AutoConfig").from_pretrained(path)
+            if spec["model"].startswith("Auto"):
+                # auto classes need a path; the config names the concrete class
+                model_class = transformers_class(config.architectures[0])
+            model = model_class.from_pretrained(None, config=config, state_dict=load_file(weights_path))
+        else:
+            model = model_class.from_pretrained(path)
+        model.eval()
+    with timed(timer, f"move {model_name} to {device}"):
+        model = model.to(device)
+
+    return model
+
+# save a local snapshot of a model (tokenizer, config and weights, the latter
+# also as model.safetensors) so it loads without network access; the
+# snapshot records the versions it was made with
+def snapshot_model(model_name, snapshot_dir=SNAPSHOT_DIR):
+    from safetensors.torch import save_file
+
+    path = snapshot_path(model_name, snapshot_dir)
+    tokenizer = load_tokenizer(model_name, snapshot_dir=snapshot_dir)
+    model = load_model(model_name, snapshot_dir=snapshot_dir)
+
+    tokenizer.save_pretrained(path)
+    model.save_pretrained(path)
+
+    weights_path = os.path.join(path, "model.safetensors")
+    if not os.path.isfile(weights_path):
+        # tied weights (e.g. gpt2's lm_head) are stored once and re-tied on load
+        state_dict = {}
+        stored = set()
+        for name, tensor in model.state_dict().items():
+            if tensor.data_ptr() not in stored:
+                stored.add(tensor.data_ptr())
+                state_dict[name] = tensor.contiguous()
+        save_file(state_dict, weights_path, metadata={"format": "pt"})
+
+    with open(os.path.join(path, "snapshot.json"), "w") as f:
+        json.dump({
+            "model_name": model_name,
+            "transformers_version": importlib.import_module("transformers").__version__,
+            "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+        }, f, indent=4)
+
+    return path
+
+
+if __name__ == "__main__":
+    # snapshot every registered model (or the ones named on the command line)
+    for model_name in sys.argv[1:] or MODELS:
+        print(f"Snapshotting {model_name} to {snapshot_model(model_name)}")
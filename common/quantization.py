@@ -0,0 +1,95 @@
+import copy
+import io
+import math
+
+import torch
+
+# dynamic int8 quantization for CPU inference: the weights of a model's
+# Linear layers are stored as int8 and activations are quantized on the
+# fly, so the dense matmuls that dominate gpt2 scoring and t5 decoding run
+# in int8. quantized models only run on CPU, and since activations are
+# quantized per batch, their outputs depend slightly on batch composition
+
+# helper function to replace gpt2's Conv1D layers (Linear layers with a
+# transposed weight) with equivalent Linear layers, so they get quantized too
+def conv1d_to_linear(module):
+    for name, child in module.named_children():
+        if type(child).__name__ == "Conv1D":
+            linear = torch.nn.Linear(*child.weight.shape)
+            linear.weight.data = child.weight.data.t().contiguous()
+            linear.bias.data = child.bias.data
+            setattr(module, name, linear)
+        else:
+            conv1d_to_linear(child)
+
+    return module
+
+# quantized copy of a model (the original is left untouched, e.g. to compare against)
+def quantize_model(model):
+    model = conv1d_to_linear(copy.deepcopy(model).to("cpu"))
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True).eval()
+
+# helper function to measure the serialized size of a model's weights
+# (quantized weights live in packed params rather than parameters)
+def model_size_bytes(model):
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+
+    return buffer.tell()
+
+# helper function to compute the relative difference of a metric
+def relative_drift(reference, value):
+    if reference == value:
+        return 0.0
+    return abs(value - reference) / abs(reference) if reference != 0 else math.inf
+
+# compare a quantized model against its fp32 reference on a sample: the
+# relative drift of each metric ({name: (reference, quantized)}), the
+# speedup and the reduction in model size. the report is printed, and a
+# ValueError raised if any metric drifted by more than max_drift. metrics
+# that are noisy on a small sample can come with a significance test
+# ({name: {"p_value": ..., ...}}, e.g. a paired bootstrap test of the fp32
+# model beating the quantized one); those only fail if the drift is also
+# significant at alpha
+def compare_quantized(metrics, reference_seconds, quantized_seconds, reference_model, quantized_model, max_drift,
+                      significance_tests=None, alpha=0.05):
+    significance_tests = significance_tests or {}
+    report = {
+        "metrics": {
+            name: {
+                "fp32": reference,
+                "int8": quantized,
+                "relative_drift": relative_drift(reference, quantized),
+                **({"significance_test": significance_tests[name]} if name in significance_tests else {}),
+            }
+            for name, (reference, quantized) in metrics.items()
+        },
+        "fp32_seconds": reference_seconds,
+        "int8_seconds": quantized_seconds,
+        "speedup": reference_seconds / quantized_seconds if quantized_seconds > 0 else math.inf,
+        "fp32_model_bytes": model_size_bytes(reference_model),
+        "int8_model_bytes": model_size_bytes(quantized_model),
+        "max_drift": max_drift,
+        "alpha": alpha,
+    }
+    report["memory_reduction"] = 1 - report["int8_model_bytes"] / report["fp32_model_bytes"]
+
+    for name, metric in report["metrics"].items():
+        print(f"{name}: fp32 {metric['fp32']:.4f}, int8 {metric['int8']:.4f} "
+              f"(drift {100 * metric['relative_drift']:.2f}%" +
+              (f", p = {metric['significance_test']['p_value']:.3f})" if "significance_test" in metric else ")"))
+    print(f"int8 speedup {report['speedup']:.2f}x, model size {report['fp32_model_bytes'] / 2**20:.1f}MB -> "
+          f"{report['int8_model_bytes'] / 2**20:.1f}MB ({100 * report['memory_reduction']:.1f}% smaller)")
+
+    drifted = [
+        name for name, metric in report["metrics"].items()
+        if not metric["relative_drift"] <= max_drift and
+        ("significance_test" not in metric or metric["significance_test"]["p_value"] < alpha)
+    ]
+    if drifted:
+        raise ValueError(
+            f'int8 quantization changed {", ".join(drifted)} by more than {100 * max_drift:g}% on the sample; '
+            f'run without quantization or raise the drift threshold'
+        )
+
+    return report
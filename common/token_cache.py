@@ -0,0 +1,110 @@
+import hashlib
+import itertools
+import json
+import os
+import shutil
+
+import numpy as np
+
+# token caches live at the top level of the repo (next to data/), so
+# training, translation eval and perplexity scripts all share them
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cache', 'tokens')
+
+# helper function to hash the contents of a (possibly very large) file
+def file_hash(path, chunk_size=1 << 20):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+
+    return sha.hexdigest()
+
+# helper function to identify a tokenizer for the purposes of caching
+def tokenizer_fingerprint(tokenizer):
+    return {
+        "name": tokenizer.name_or_path,
+        "revision": tokenizer.init_kwargs.get("revision"),
+        "class": type(tokenizer).__name__,
+        "vocab_size": len(tokenizer),
+    }
+
+# content-addressed cache key: changes whenever a corpus file, the
+# tokenizer or any option that affects the token ids (context type,
+# break token, max length, ...) changes
+def cache_key(corpus_files, tokenizer, **options):
+    key = {
+        "files": [file_hash(corpus_file) for corpus_file in corpus_files],
+        "tokenizer": tokenizer_fingerprint(tokenizer),
+        "options": options,
+    }
+
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+
+# ragged array of token id sequences, stored as one flat int32 array of
+# token ids plus an int64 array of offsets into it; sequence i is
+# ids[offsets[i]:offsets[i + 1]]. indexing returns views, so sequences
+# loaded from a memory-mapped cache are never copied
+class TokenArray:
+    def __init__(self, ids, offsets):
+        self.ids = ids
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.ids[self.offsets[i]:self.offsets[i + 1]]
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    # build an (in-memory) token array from a list of token id lists
+    @classmethod
+    def from_encodings(cls, encodings):
+        offsets = np.zeros(len(encodings) + 1, dtype=np.int64)
+        np.cumsum([len(encoding) for encoding in encodings], out=offsets[1:])
+
+        ids = np.fromiter(itertools.chain.from_iterable(encodings), dtype=np.int32, count=offsets[-1])
+
+        return cls(ids, offsets)
+
+    def save(self, path_prefix):
+        np.save(path_prefix + '.ids.npy', self.ids)
+        np.save(path_prefix + '.offsets.npy', self.offsets)
+
+    # memory-map a saved token array; copy-on-write mode so the arrays can
+    # be wrapped in (writable) torch tensors without copying or touching the file
+    @classmethod
+    def load(cls, path_prefix):
+        return cls(
+            np.load(path_prefix + '.ids.npy', mmap_mode='c'),
+            np.load(path_prefix + '.offsets.npy', mmap_mode='c'),
+        )
+
+# load the token arrays cached under key, or call encode (which returns a
+# dict of column name -> list of token id lists), cache its results and
+# load those. an entry is written to a temporary directory and renamed into
+# place, so interrupted runs never leave a partial entry behind
+def cached_token_arrays(key, encode, cache_dir=CACHE_DIR):
+    entry_dir = os.path.join(cache_dir, key)
+
+    if not os.path.isdir(entry_dir):
+        columns = encode()
+
+        tmp_dir = entry_dir + f'.tmp{os.getpid()}'
+        os.makedirs(tmp_dir, exist_ok=True)
+        for name, encodings in columns.items():
+            TokenArray.from_encodings(encodings).save(os.path.join(tmp_dir, name))
+        with open(os.path.join(tmp_dir, 'columns.json'), 'w') as f:
+            json.dump(list(columns), f)
+
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # another process cached the same entry first
+            shutil.rmtree(tmp_dir)
+
+    with open(os.path.join(entry_dir, 'columns.json'), 'r') as f:
+        names = json.load(f)
+
+    return {name: TokenArray.load(os.path.join(entry_dir, name)) for name in names}
@@ -0,0 +1,107 @@
+from argparse import Namespace
+from multiprocessing import Pool
+
+import numpy as np
+from sacrebleu import DEFAULT_TOKENIZER
+from sacrebleu.metrics import BLEU
+
+# BLEU's sufficient statistics are sums over sentences, so once every
+# sentence's statistics are known the corpus BLEU of any resample of the
+# sentences is a matrix product away. per-sentence statistics are stored
+# as rows of an int64 array with columns
+#
+#   hypothesis length, reference length, n-gram matches (n = 1..4),
+#   hypothesis n-grams (n = 1..4)
+#
+# and scores follow sacrebleu.corpus_bleu with its default settings
+# (13a tokenization, exponential smoothing)
+NGRAM_ORDER = BLEU.NGRAM_ORDER
+
+# helper function to compute the statistics of a list of (hypothesis,
+# reference) pairs with the same metric settings as sacrebleu.corpus_bleu
+def pair_statistics(pairs):
+    metric = BLEU(Namespace(
+        smooth_method='exp', smooth_value=None, force=True, short=False, lc=False, tokenize=DEFAULT_TOKENIZER))
+
+    statistics = np.zeros((len(pairs), 2 + 2 * NGRAM_ORDER), dtype=np.int64)
+    for i, (hypothesis, reference) in enumerate(pairs):
+        score = metric.corpus_score([hypothesis], [[reference]])
+        statistics[i] = [score.sys_len, score.ref_len, *score.counts, *score.totals]
+
+    return statistics
+
+# compute the per-sentence statistics of hypotheses against a single
+# reference each, optionally split across a pool of worker processes
+def sentence_statistics(hypotheses, references, workers=1, chunk_size=10000):
+    pairs = list(zip(hypotheses, references))
+    if workers <= 1 or len(pairs) <= chunk_size:
+        return pair_statistics(pairs)
+
+    chunks = [pairs[i:i + chunk_size] for i in range(0, len(pairs), chunk_size)]
+    with Pool(workers) as pool:
+        return np.concatenate(pool.map(pair_statistics, chunks))
+
+# corpus BLEU from summed statistics; works on a single row of statistics
+# or any array of them (e.g. one row per bootstrap sample)
+def bleu_from_statistics(statistics):
+    statistics = np.asarray(statistics, dtype=np.float64)
+    sys_len = statistics[..., 0]
+    ref_len = statistics[..., 1]
+    correct = statistics[..., 2:2 + NGRAM_ORDER]
+    total = statistics[..., 2 + NGRAM_ORDER:]
+
+    # exponential smoothing: the k-th n-gram order without matches gets a
+    # precision of 1 / (2^k * total); orders with no n-grams at all score 0
+    smoothing = 2.0 ** np.cumsum(correct == 0, axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        precisions = np.where(correct > 0, correct / total, 1.0 / (smoothing * total))
+        log_precision = np.where(total > 0, np.log(precisions), -np.inf).mean(axis=-1)
+        brevity_penalty = np.where(
+            sys_len < ref_len, np.where(sys_len > 0, np.exp(1 - ref_len / sys_len), 0.0), 1.0)
+
+    return 100 * brevity_penalty * np.exp(log_precision)
+
+# helper function to compute the BLEU scores of several systems on the same
+# num_samples bootstrap resamples of the sentences (so scores are paired)
+def bootstrap_chunk(job):
+    system_statistics, num_samples, seed = job
+    rng = np.random.default_rng(seed)
+    num_sentences = system_statistics[0].shape[0]
+
+    # how often each sentence is drawn in each resample
+    counts = rng.multinomial(num_sentences, np.full(num_sentences, 1 / num_sentences), size=num_samples)
+
+    return np.stack([bleu_from_statistics(counts @ statistics) for statistics in system_statistics])
+
+# bootstrap the corpus BLEU of several systems evaluated on the same
+# sentences: returns an array of shape (systems, num_samples), where column
+# j holds every system's score on the j-th resample. resamples are drawn
+# chunk_size at a time (bounding memory), optionally in a pool of workers
+def bootstrap_scores(system_statistics, num_samples=1000, seed=0, workers=1, chunk_size=100):
+    chunk_sizes = [min(chunk_size, num_samples - start) for start in range(0, num_samples, chunk_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(chunk_sizes))
+    jobs = [(system_statistics, size, chunk_seed) for size, chunk_seed in zip(chunk_sizes, seeds)]
+
+    if workers <= 1:
+        chunks = [bootstrap_chunk(job) for job in jobs]
+    else:
+        with Pool(workers) as pool:
+            chunks = pool.map(bootstrap_chunk, jobs)
+
+    return np.concatenate(chunks, axis=1)
+
+# helper function to turn bootstrap samples into a (lower, upper) confidence interval
+def confidence_interval(samples, confidence=0.95):
+    lower, upper = np.percentile(samples, [50 * (1 - confidence), 50 * (1 + confidence)])
+    return [float(lower), float(upper)]
+
+# paired bootstrap test of whether a system's BLEU beats a baseline's
+# (Koehn, 2004): the p-value is the fraction of resamples on which the
+# system does not score higher than the baseline
+def paired_bootstrap_test(system_samples, baseline_samples, confidence=0.95):
+    deltas = system_samples - baseline_samples
+
+    return {
+        "delta_confidence_interval": confidence_interval(deltas, confidence),
+        "p_value": float(np.mean(deltas <= 0)),
+    }
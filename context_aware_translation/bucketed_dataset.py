@@ -0,0 +1,117 @@
+import numpy as np
+import torch
+from torch.utils.data import Dataset, Sampler
+
+from cached_dataset import load_token_arrays
+
+# map-style dataset of unpadded (input_ids, labels) token id arrays of a
+# preprocessed dataframe, for batching with LengthBucketBatchSampler and
+# padding with DynamicPaddingCollator (each batch only to its own longest
+# sequence, instead of every example to max_seq_length)
+class DynamicPaddingDataset(Dataset):
+    def __init__(self, tokenizer, data, max_seq_length, use_cache=True):
+        token_arrays = load_token_arrays(tokenizer, data, max_seq_length, use_cache)
+        self.input_ids = token_arrays["input_ids"]
+        self.labels = token_arrays["labels"]
+
+    def __len__(self):
+        return len(self.input_ids)
+
+    def __getitem__(self, i):
+        return self.input_ids[i], self.labels[i]
+
+    # source and target length of every example
+    def lengths(self):
+        return np.asarray(self.input_ids.lengths()), np.asarray(self.labels.lengths())
+
+# batch sampler that groups examples of similar length: each epoch the
+# examples are shuffled, cut into buckets of bucket_size examples, sorted by
+# length within each bucket and split into batches, and the batches are
+# shuffled. a batch holds at most batch_size examples and, with max_tokens,
+# at most max_tokens padded source plus target tokens
+class LengthBucketBatchSampler(Sampler):
+    def __init__(self, source_lengths, target_lengths, batch_size=None, max_tokens=None, bucket_size=100000,
+                 shuffle=True, seed=0):
+        self.source_lengths = np.asarray(source_lengths)
+        self.target_lengths = np.asarray(target_lengths)
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.bucket_size = bucket_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+
+    # reshuffle differently on every pass over the data
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    # helper function to split indices (sorted by length) into batches
+    def split_batches(self, indices):
+        batches = []
+        batch = []
+        max_source_length = 0
+        max_target_length = 0
+        for i in indices.tolist():
+            source_length = max(max_source_length, self.source_lengths[i])
+            target_length = max(max_target_length, self.target_lengths[i])
+            if batch and ((self.batch_size is not None and len(batch) == self.batch_size) or
+                          (self.max_tokens is not None and
+                           (len(batch) + 1) * (source_length + target_length) > self.max_tokens)):
+                batches.append(batch)
+                batch = []
+                source_length = self.source_lengths[i]
+                target_length = self.target_lengths[i]
+
+            batch.append(i)
+            max_source_length = source_length
+            max_target_length = target_length
+
+        if batch:
+            batches.append(batch)
+
+        return batches
+
+    def batches(self):
+        rng = np.random.default_rng([self.seed, self.epoch])
+        indices = rng.permutation(len(self.source_lengths)) if self.shuffle else np.arange(len(self.source_lengths))
+
+        batches = []
+        for start in range(0, len(indices), self.bucket_size):
+            bucket = indices[start:start + self.bucket_size]
+            lengths = self.source_lengths[bucket] + self.target_lengths[bucket]
+            batches.extend(self.split_batches(bucket[np.argsort(lengths, kind='stable')]))
+
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+
+        return batches
+
+    def __iter__(self):
+        return iter(self.batches())
+
+    def __len__(self):
+        return len(self.batches())
+
+# collate function padding a batch of (input_ids, labels) to the longest
+# source and target in the batch; returns (input_ids, attention_mask,
+# labels) like the fixed-length datasets, so the training loop is shared
+class DynamicPaddingCollator:
+    def __init__(self, pad_token_id):
+        self.pad_token_id = pad_token_id
+
+    # helper function to right-pad token id arrays into one tensor
+    def pad(self, sequences):
+        padded = torch.full((len(sequences), max(len(ids) for ids in sequences)), self.pad_token_id, dtype=torch.long)
+        for i, ids in enumerate(sequences):
+            padded[i, :len(ids)] = torch.from_numpy(np.asarray(ids, dtype=np.int64))
+
+        return padded
+
+    def __call__(self, batch):
+        input_ids = self.pad([source for source, _ in batch])
+        labels = self.pad([target for _, target in batch])
+        attention_mask = torch.zeros_like(input_ids)
+        for i, (source, _) in enumerate(batch):
+            attention_mask[i, :len(source)] = 1
+
+        return input_ids, attention_mask, labels
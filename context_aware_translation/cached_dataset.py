@@ -0,0 +1,78 @@
+import hashlib
+
+import pandas as pd
+import torch
+from torch.utils.data import Dataset
+
+from common.token_cache import TokenArray, cache_key, cached_token_arrays
+
+# tokenize the source and target text of a preprocessed dataframe the same
+# way simpletransformers' T5Dataset does (truncated to max_seq_length, with
+# eos), without padding
+def encode_examples(tokenizer, data, max_seq_length):
+    source_texts = (data["prefix"] + data["input_text"]).tolist()
+    target_texts = data["target_text"].tolist()
+
+    return {
+        "input_ids": tokenizer(source_texts, max_length=max_seq_length, truncation=True).input_ids,
+        "labels": tokenizer(target_texts, max_length=max_seq_length, truncation=True).input_ids,
+    }
+
+# helper function to identify which rows of a preprocessed dataframe (and
+# in which order) a dataframe holds, by its number of rows and row index
+def row_fingerprint(data):
+    index_hash = hashlib.sha256(pd.util.hash_pandas_object(data.index, index=False).values.tobytes()).hexdigest()
+    return [len(data), index_hash]
+
+# load the token ids of a preprocessed dataframe from the on-disk token
+# cache, tokenizing (and caching) them only if the corpus files, tokenizer
+# or preprocessing options changed since the last run; dataframes without
+# a reproducible source (or with use_cache=False) are tokenized in memory.
+# pandas carries the source over to subsets of a dataframe (head, sample,
+# slices, ...), so the rows it holds are part of the key too
+def load_token_arrays(tokenizer, data, max_seq_length, use_cache=True):
+    source = data.attrs.get("source")
+    if source is None or not use_cache:
+        columns = encode_examples(tokenizer, data, max_seq_length)
+        return {name: TokenArray.from_encodings(encodings) for name, encodings in columns.items()}
+
+    key = cache_key(
+        source["corpus_files"],
+        tokenizer,
+        context_type=source["context_type"],
+        break_token=source["break_token"],
+        seed=source["seed"],
+        max_seq_length=max_seq_length,
+        rows=row_fingerprint(data),
+    )
+
+    return cached_token_arrays(key, lambda: encode_examples(tokenizer, data, max_seq_length))
+
+# drop-in replacement for simpletransformers' T5Dataset (set it as
+# model_args.dataset_class) that reads token ids from the token cache;
+# items are (input_ids, attention_mask, labels) padded to max_seq_length
+class CachedT5Dataset(Dataset):
+    def __init__(self, tokenizer, args, data, mode):
+        self.max_seq_length = args.max_seq_length
+        self.pad_token_id = tokenizer.pad_token_id
+
+        token_arrays = load_token_arrays(tokenizer, data, args.max_seq_length)
+        self.input_ids = token_arrays["input_ids"]
+        self.labels = token_arrays["labels"]
+
+    def __len__(self):
+        return len(self.input_ids)
+
+    # helper function to pad a cached sequence to max_seq_length
+    def pad(self, ids):
+        padded = torch.full((self.max_seq_length,), self.pad_token_id, dtype=torch.long)
+        padded[:len(ids)] = torch.from_numpy(ids)
+
+        return padded
+
+    def __getitem__(self, i):
+        input_ids = self.pad(self.input_ids[i])
+        attention_mask = (torch.arange(self.max_seq_length) < len(self.input_ids[i])).long()
+        labels = self.pad(self.labels[i])
+
+        return input_ids, attention_mask, labels
@@ -1,13 +1,26 @@
 import json
 import os
+import sys
 
 import sacrebleu
 import pandas as pd
 
 import torch
-from simpletransformers.t5 import T5Model, T5Args
 
-from preprocess import preprocess
+# make the shared modules at the top of the repo importable
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from preprocess import preprocess_context_types
+from inference import translate
+from translation_cache import TranslationCache, translation_key, cached_translate
+from bleu import sentence_statistics, bootstrap_scores, confidence_interval, paired_bootstrap_test
+from common.model_registry import StartupTimer
+from common.quantization import quantize_model, compare_quantized
+from common.instrumentation import start_run, finish_run
+
+# helper function to keep only the (last) target sentence of translations
+def target_sentences(translations, break_token):
+    return [translation.split(break_token)[-1] for translation in translations]
 
 # helper function to calculate bleu score ignoring context
 # sentence (if provided) and removing separator tokens
@@ -16,90 +29,248 @@ def target_sentence_bleu(model_translations, gold_translations, break_token):
     # separator tokens from model translations
     # since we only want to evaluate the quality of the (second)
     # target sentence translation, not the (first) context sentence
-    target_model_translations = [
-        model_translation.split(break_token)[-1]
-        for model_translation in model_translations
-    ]
+    target_model_translations = target_sentences(model_translations, break_token)
 
     # remove context sentence (if provided) and
     # separator tokens from gold translations
     # since we only want to evaluate the quality of the (second)
     # target sentence translation, not the (first) context sentence
     target_gold_translations = [
-        [
-            gold_translation.split(break_token)[-1]
-            for gold_translation in gold_translation_option
-        ]
+        target_sentences(gold_translation_option, break_token)
         for gold_translation_option in gold_translations
     ]
 
     return sacrebleu.corpus_bleu(target_model_translations, target_gold_translations)
 
-eval_params = {
-    # where to output results of evaluation
-    "OUTPUT_PATH": "./experiments/20210601_1917_6c01bf8/eval/",
-
-    # which model to evaluate
-    "MODEL_DIR": "./experiments/20210601_1917_6c01bf8/best_model",
-    "TRAINING_PARAMS_PATH": "./experiments/20210601_1917_6c01bf8/params.json",
-
-    # eval data
-    "CORPUS": "four_way_parallel_corpus",
-    "LANGUAGE_PAIR": "en-ja",
-    "CONTEXT_TYPE": "random-context",
-
-    # eval specifics
-    "MAX_SEQ_LENGTH": 128,
-    "LENGTH_PENALTY": 1,
-    "BEAM_WIDTH": 5,
-}
-
-# load tokenizer, model, and training params
-with open(eval_params["TRAINING_PARAMS_PATH"], "r") as f:
-    training_params = json.load(f)
-
-with open(eval_params["MODEL_DIR"] + "/model_args.json", "r") as f:
-    model_params = json.load(f)
-
-with open(eval_params["MODEL_DIR"] + "/tokenizer_config.json", "r") as f:
-    tokenizer_params = json.load(f)
-
-# load trained model
-model_args = T5Args()
-model_args.max_length = eval_params["MAX_SEQ_LENGTH"]
-model_args.length_penalty = eval_params["LENGTH_PENALTY"]
-model_args.num_beams = eval_params["BEAM_WIDTH"]
-
-model = T5Model(
-    model_params["model_type"],
-    eval_params["MODEL_DIR"],
-    args=model_args,
-    use_cuda = torch.cuda.is_available()
-)
-
-# load in evaluation data
-eval_df = preprocess(eval_params["CORPUS"], eval_params["LANGUAGE_PAIR"], 'eval', eval_params["CONTEXT_TYPE"], training_params["BREAK_TOKEN"])
-source_sentences = eval_df["input_text"].tolist()
-gold_translations = [eval_df["target_text"].tolist()]
-
-# predict using trained model
-model_translations = model.predict(source_sentences)
-
-# calculate bleu score
-bleu_score = sacrebleu.corpus_bleu(model_translations, gold_translations)
-
-# calculate bleu score without context sentence (and sep tokens)
-contextless_bleu_score = target_sentence_bleu(model_translations, gold_translations, training_params["BREAK_TOKEN"])
-
-# save down results
-if not os.path.isdir(eval_params["OUTPUT_PATH"]):
-    os.makedirs(eval_params["OUTPUT_PATH"])
-
-with open(eval_params["OUTPUT_PATH"] + eval_params["CONTEXT_TYPE"] + ".json", "w") as f:
-    json.dump({
-        **eval_params,
-        "raw_bleu_score": bleu_score.score,
-        "raw_bleu_score_signature": bleu_score.format(),
-        "target_bleu_score": contextless_bleu_score.score,
-        "target_bleu_score_signature": contextless_bleu_score.format(),
-    }, f, indent=4)
+# evaluate a trained model on every context type of the eval split: bleu
+# scores, bootstrap confidence intervals and significance tests are saved
+# per context type and in a summary. the bleu pools spawn worker processes
+# that re-import this module, so nothing runs at import time
+def evaluate_translations(eval_params):
+    # time each phase of starting up (reported before translating)
+    timer = StartupTimer()
+
+    # record per-stage timings (and profile) into the output dir when INSTRUMENT is set
+    start_run(eval_params["OUTPUT_PATH"])
+
+    # load tokenizer, model, and training params
+    with open(eval_params["TRAINING_PARAMS_PATH"], "r") as f:
+        training_params = json.load(f)
+
+    with open(eval_params["MODEL_DIR"] + "/model_args.json", "r") as f:
+        model_params = json.load(f)
+
+    with open(eval_params["MODEL_DIR"] + "/tokenizer_config.json", "r") as f:
+        tokenizer_params = json.load(f)
+
+    # load trained model
+    with timer.phase("import simpletransformers"):
+        from simpletransformers.t5 import T5Model, T5Args
+
+    model_args = T5Args()
+    model_args.max_length = eval_params["MAX_SEQ_LENGTH"]
+    model_args.length_penalty = eval_params["LENGTH_PENALTY"]
+    model_args.num_beams = eval_params["BEAM_WIDTH"]
+
+    with timer.phase("load model"):
+        model = T5Model(
+            model_params["model_type"],
+            eval_params["MODEL_DIR"],
+            args=model_args,
+            # quantized models only run on CPU
+            use_cuda = torch.cuda.is_available() and not eval_params["QUANTIZE"]
+        )
+
+    # load in evaluation data for every context type
+    with timer.phase("preprocess"):
+        eval_dfs = preprocess_context_types(
+            eval_params["CORPUS"], eval_params["LANGUAGE_PAIR"], 'eval', eval_params["CONTEXT_TYPES"], training_params["BREAK_TOKEN"])
+    timer.report()
+
+    quantization_report = None
+    if eval_params["QUANTIZE"]:
+        # compare the quantized model against the fp32 one on a sample before translating with it
+        sample_df = next(iter(eval_dfs.values()))
+        sample_df = sample_df.sample(n=min(eval_params["QUANTIZATION_SAMPLE_SIZE"], len(sample_df)), random_state=0)
+        reference_model = model.model
+        quantized_model = quantize_model(reference_model)
+
+        sample_bleu_scores = []
+        sample_target_statistics = []
+        sample_seconds = []
+        for translation_model in (reference_model, quantized_model):
+            model.model = translation_model
+            sample_translations, sample_statistics = translate(
+                model, sample_df["input_text"].tolist(), max_tokens=eval_params["MAX_TOKENS"])
+            sample_bleu_scores.append(target_sentence_bleu(
+                sample_translations, [sample_df["target_text"].tolist()], training_params["BREAK_TOKEN"]).score)
+            sample_target_statistics.append(sentence_statistics(
+                target_sentences(sample_translations, training_params["BREAK_TOKEN"]),
+                target_sentences(sample_df["target_text"].tolist(), training_params["BREAK_TOKEN"]),
+            ))
+            sample_seconds.append(sample_statistics["seconds"])
+
+        # bleu on a sample is noisy, so a drift only counts if the fp32 model is
+        # significantly better on paired resamples of the sample
+        reference_samples, quantized_samples = bootstrap_scores(
+            sample_target_statistics, num_samples=eval_params["BOOTSTRAP_SAMPLES"], workers=eval_params["BLEU_WORKERS"])
+        quantization_report = compare_quantized(
+            {"target_bleu_score": tuple(sample_bleu_scores)},
+            *sample_seconds,
+            reference_model,
+            quantized_model,
+            eval_params["QUANTIZATION_MAX_DRIFT"],
+            significance_tests={"target_bleu_score": paired_bootstrap_test(reference_samples, quantized_samples)},
+        )
+        del reference_model
+
+    if eval_params["TRANSLATION_CACHE"]:
+        translation_cache = TranslationCache(max_entries=eval_params["TRANSLATION_CACHE_MAX_ENTRIES"])
+        translation_cache_key = translation_key(
+            eval_params["MODEL_DIR"],
+            max_seq_length=model.args.max_seq_length,
+            max_length=model.args.max_length,
+            length_penalty=model.args.length_penalty,
+            num_beams=model.args.num_beams,
+            early_stopping=model.args.early_stopping,
+            repetition_penalty=model.args.repetition_penalty,
+            # quantized translations are kept apart from fp32 ones
+            **({"quantization": "dynamic-int8"} if eval_params["QUANTIZE"] else {}),
+        )
+
+    if not os.path.isdir(eval_params["OUTPUT_PATH"]):
+        os.makedirs(eval_params["OUTPUT_PATH"])
+
+    all_results = {}
+    all_target_statistics = {}
+    for context_type, eval_df in eval_dfs.items():
+        source_sentences = eval_df["input_text"].tolist()
+        gold_translations = [eval_df["target_text"].tolist()]
+
+        # predict using trained model
+        if eval_params["TRANSLATION_CACHE"]:
+            model_translations, translation_statistics = cached_translate(
+                model, source_sentences, translation_cache, translation_cache_key, max_tokens=eval_params["MAX_TOKENS"])
+        else:
+            model_translations, translation_statistics = translate(model, source_sentences, max_tokens=eval_params["MAX_TOKENS"])
+        print(f'{context_type}: translated {translation_statistics["sentences"]} sentences in '
+              f'{translation_statistics["seconds"]:.1f}s ({translation_statistics["sentences_per_second"]:.1f} sentences/s, '
+              f'{translation_statistics["tokens_per_second"]:.1f} tokens/s)')
+
+        # calculate bleu score
+        bleu_score = sacrebleu.corpus_bleu(model_translations, gold_translations)
+
+        # calculate bleu score without context sentence (and sep tokens)
+        contextless_bleu_score = target_sentence_bleu(model_translations, gold_translations, training_params["BREAK_TOKEN"])
+
+        # per-sentence bleu statistics of the target sentences, for bootstrapping
+        all_target_statistics[context_type] = sentence_statistics(
+            target_sentences(model_translations, training_params["BREAK_TOKEN"]),
+            target_sentences(gold_translations[0], training_params["BREAK_TOKEN"]),
+            workers=eval_params["BLEU_WORKERS"],
+        )
+
+        all_results[context_type] = {
+            "raw_bleu_score": bleu_score.score,
+            "raw_bleu_score_signature": bleu_score.format(),
+            "target_bleu_score": contextless_bleu_score.score,
+            "target_bleu_score_signature": contextless_bleu_score.format(),
+            "translation_statistics": translation_statistics,
+        }
+
+    if eval_params["TRANSLATION_CACHE"]:
+        translation_cache.close()
+
+    # bootstrap every context type on the same resamples of the sentences, so
+    # context types can be compared pairwise
+    context_types = list(all_results)
+    bootstrap_samples = dict(zip(context_types, bootstrap_scores(
+        [all_target_statistics[context_type] for context_type in context_types],
+        num_samples=eval_params["BOOTSTRAP_SAMPLES"],
+        workers=eval_params["BLEU_WORKERS"],
+    )))
+
+    summary = {}
+    for context_type, results in all_results.items():
+        results["target_bleu_confidence_interval"] = confidence_interval(bootstrap_samples[context_type])
+
+        baseline = eval_params["SIGNIFICANCE_BASELINE"]
+        if baseline in bootstrap_samples and context_type != baseline:
+            results["target_bleu_paired_bootstrap"] = {
+                "baseline": baseline,
+                **paired_bootstrap_test(bootstrap_samples[context_type], bootstrap_samples[baseline]),
+            }
+
+        # save down results
+        with open(eval_params["OUTPUT_PATH"] + context_type + ".json", "w") as f:
+            json.dump({
+                **{param: value for param, value in eval_params.items() if param != "CONTEXT_TYPES"},
+                "CONTEXT_TYPE": context_type,
+                **results,
+            }, f, indent=4)
+
+        summary[context_type] = {
+            key: value for key, value in results.items()
+            if key in ("raw_bleu_score", "target_bleu_score", "target_bleu_confidence_interval", "target_bleu_paired_bootstrap")
+        }
+
+    # save down a summary of all context types
+    with open(eval_params["OUTPUT_PATH"] + "summary.json", "w") as f:
+        json.dump({
+            **eval_params,
+            "results": summary,
+            **({"quantization": quantization_report} if quantization_report is not None else {}),
+        }, f, indent=4)
+
+    finish_run()
+
+
+if __name__ == "__main__":
+    eval_params = {
+        # where to output results of evaluation
+        "OUTPUT_PATH": "./experiments/20210601_1917_6c01bf8/eval/",
+
+        # which model to evaluate
+        "MODEL_DIR": "./experiments/20210601_1917_6c01bf8/best_model",
+        "TRAINING_PARAMS_PATH": "./experiments/20210601_1917_6c01bf8/params.json",
+
+        # eval data
+        "CORPUS": "four_way_parallel_corpus",
+        "LANGUAGE_PAIR": "en-ja",
+        # every context type is evaluated with one model load and one read of the corpus
+        "CONTEXT_TYPES": ["2-to-2", "no-context-with-break", "no-context-without-break", "random-context"],
+
+        # eval specifics
+        "MAX_SEQ_LENGTH": 128,
+        "LENGTH_PENALTY": 1,
+        # 1 for greedy decoding; fewer beams trade some bleu for speed
+        "BEAM_WIDTH": 5,
+
+        # cap on padded source tokens (times beam width) decoded per batch;
+        # inputs are sorted by length so batches are padded as little as possible
+        "MAX_TOKENS": 8192,
+
+        # reuse translations of source sentences already translated by the same
+        # checkpoint with the same decoding settings (e.g. in an eval of another
+        # context type), keeping at most this many translations on disk
+        "TRANSLATION_CACHE": True,
+        "TRANSLATION_CACHE_MAX_ENTRIES": 1000000,
+
+        # bootstrap resamples for confidence intervals of the target bleu scores
+        # and paired significance tests of each context type against the baseline
+        "BOOTSTRAP_SAMPLES": 1000,
+        "SIGNIFICANCE_BASELINE": "no-context-with-break",
+        "BLEU_WORKERS": 4,
+
+        # translate with dynamic int8 quantization of the model's Linear layers
+        # (CPU only). a random sample of the first context type is translated
+        # with both the fp32 and the quantized model first, and the eval stops
+        # if quantization moves the sample's target bleu by more than the
+        # relative threshold and a paired bootstrap test on the sample finds
+        # the fp32 model significantly better
+        "QUANTIZE": False,
+        "QUANTIZATION_SAMPLE_SIZE": 1000,
+        "QUANTIZATION_MAX_DRIFT": 0.02,
+    }
+
+    evaluate_translations(eval_params)
@@ -0,0 +1,90 @@
+import time
+
+import torch
+from tqdm.auto import tqdm
+
+from common.instrumentation import instrumented
+
+# helper function to group sentence indices (sorted longest first) into
+# batches whose padded size stays within a token budget: a batch of n
+# sentences padded to length l decodes n * num_beams sequences, so it
+# costs n * l * num_beams tokens. sorting by length keeps padding small
+def token_budget_batches(lengths, max_tokens, max_batch_size=None, num_beams=1):
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+
+    batches = []
+    batch = []
+    for i in order:
+        # the first (longest) sentence of a batch sets its padded length
+        padded_length = lengths[batch[0]] if batch else lengths[i]
+        if batch and ((len(batch) + 1) * max(padded_length, 1) * num_beams > max_tokens or
+                      (max_batch_size is not None and len(batch) == max_batch_size)):
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+
+    if batch:
+        batches.append(batch)
+
+    return batches
+
+# translate source sentences with a simpletransformers T5Model, in place of
+# T5Model.predict (which pads every batch to max_seq_length and batches in
+# input order): inputs are tokenized once, sorted by length, padded only to
+# the longest sentence of each batch and batched by a token budget, then
+# put back in their original order. decoding settings default to the
+# model args; num_beams=1 decodes greedily. returns the translations and
+# throughput statistics
+@instrumented(
+    "translate",
+    count=lambda result: result[1]["sentences"],
+    count_tokens=lambda result: result[1]["input_tokens"] + result[1]["output_tokens"],
+)
+def translate(model, source_sentences, max_tokens=8192, max_batch_size=None, num_beams=None, max_length=None,
+              length_penalty=None):
+    args = model.args
+    num_beams = args.num_beams if num_beams is None else num_beams
+    max_length = args.max_length if max_length is None else max_length
+    length_penalty = args.length_penalty if length_penalty is None else length_penalty
+
+    model.model.to(model.device)
+    model.model.eval()
+
+    start_time = time.perf_counter()
+    source_sentences = list(source_sentences)
+    encodings = model.tokenizer(source_sentences, max_length=args.max_seq_length, truncation=True).input_ids \
+        if source_sentences else []
+    lengths = [len(encoding) for encoding in encodings]
+
+    translations = [None] * len(encodings)
+    output_tokens = 0
+    for batch in tqdm(token_budget_batches(lengths, max_tokens, max_batch_size, num_beams), desc="Translating"):
+        inputs = model.tokenizer.pad({"input_ids": [encodings[i] for i in batch]}, return_tensors="pt")
+
+        with torch.no_grad():
+            outputs = model.model.generate(
+                input_ids=inputs["input_ids"].to(model.device),
+                attention_mask=inputs["attention_mask"].to(model.device),
+                num_beams=num_beams,
+                max_length=max_length,
+                length_penalty=length_penalty,
+                early_stopping=args.early_stopping,
+                repetition_penalty=args.repetition_penalty,
+            )
+
+        output_tokens += int((outputs != model.tokenizer.pad_token_id).sum())
+        decoded = model.tokenizer.batch_decode(outputs, skip_special_tokens=True, clean_up_tokenization_spaces=True)
+        for i, translation in zip(batch, decoded):
+            translations[i] = translation
+
+    seconds = time.perf_counter() - start_time
+    statistics = {
+        "sentences": len(encodings),
+        "input_tokens": sum(lengths),
+        "output_tokens": output_tokens,
+        "seconds": seconds,
+        "sentences_per_second": len(encodings) / seconds if seconds > 0 else 0.0,
+        "tokens_per_second": (sum(lengths) + output_tokens) / seconds if seconds > 0 else 0.0,
+    }
+
+    return translations, statistics
@@ -1,95 +1,190 @@
 import os
-import random
+from array import array
+from collections import deque
+
+import numpy as np
 import pandas as pd
 
+from common.columnar_corpus import ColumnarCorpus, columnar_up_to_date
+from common.context_windows import ContextExamples, context_indices, context_slots
+from common.instrumentation import instrumented
+
 # helper function to construct path to corpus files
 def corpus_path(corpus, language_pair, split, file_type):
     return f'../data/{corpus}/{split}/{language_pair}/OpenSubtitles.{language_pair}.{file_type}'
 
-def preprocess(corpus, language_pair, split, context_type, break_token):
+# helper function to open the columnar (memory-mapped) version of a corpus,
+# if it has been converted (see data/convert_to_columnar.py) since its text
+# files were last written
+def open_columnar_corpus(corpus, language_pair, split):
+    path = corpus_path(corpus, language_pair, split, 'columnar')
+    text_paths = [corpus_path(corpus, language_pair, split, file_type) for file_type in (*language_pair.split('-'), 'ids')]
+    return ColumnarCorpus(path) if columnar_up_to_date(path, text_paths) else None
+
+# helper function to put examples in a dataframe, recording which corpus
+# files and options produced it so their tokenization can be cached
+def examples_frame(data, corpus, language_pair, split, context_type, break_token, seed=None):
+    lang_1, lang_2 = language_pair.split('-')
+    df = pd.DataFrame(data, columns=["prefix", "input_text", "target_text"])
+
+    # randomly sampled context is only reproducible given a seed
+    if not context_type.startswith('random-context') or seed is not None:
+        df.attrs["source"] = {
+            "corpus_files": [
+                corpus_path(corpus, language_pair, split, file_type)
+                for file_type in (lang_1, lang_2, 'ids')
+            ],
+            "context_type": context_type,
+            "break_token": break_token,
+            "seed": seed,
+        }
+
+    return df
+
+# random access to the stripped lines of a text file without loading it:
+# a first pass records the byte offset of every line, lines are then read
+# by seeking to them. lines end at \n, \r\n or a lone \r, like the lines
+# of a file opened in text mode (universal newlines)
+class IndexedTextLines:
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+
+        self.offsets = array('q', [0])
+        for raw_line in self.file:
+            line_start = self.offsets[-1]
+            # a lone \r inside the raw line also ends a line
+            carriage_return = raw_line.find(b'\r')
+            while carriage_return != -1 and carriage_return < len(raw_line) - 1:
+                if raw_line[carriage_return + 1:carriage_return + 2] != b'\n':
+                    self.offsets.append(line_start + carriage_return + 1)
+                carriage_return = raw_line.find(b'\r', carriage_return + 1)
+            self.offsets.append(line_start + len(raw_line))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        self.file.seek(self.offsets[i])
+        return self.file.read(self.offsets[i + 1] - self.offsets[i]).decode('utf-8').strip()
+
+    # iterate with a separate file handle, so lines can be looked up while iterating
+    def __iter__(self):
+        with open(self.file.name, 'r', encoding='utf-8') as f:
+            for line in f:
+                yield line.strip()
+
+    def close(self):
+        self.file.close()
+
+    def __del__(self):
+        # the file isn't open if indexing failed to open it
+        if hasattr(self, 'file'):
+            self.close()
+
+# helper function to compute the document-start mask of a corpus in one
+# pass over its .ids file, keeping only the previous doc id (not all of them)
+def ids_document_starts(path):
+    starts = bytearray()
+    prev_doc_id = None
+    with open(path, encoding='utf-8') as doc_ids:
+        for doc_id_line in doc_ids:
+            doc_id = doc_id_line.split()[0]
+            starts.append(doc_id != prev_doc_id)
+            prev_doc_id = doc_id
+
+    return np.frombuffer(starts, dtype=np.uint8).astype(bool)
+
+# helper function to open the aligned lines of a corpus as random-access
+# columns (memory-mapped when a columnar version exists, otherwise read by
+# seeking in the text files), along with its document-start mask
+def corpus_columns(corpus, language_pair, split):
     lang_1, lang_2 = language_pair.split('-')
-    if context_type == '2-to-2':
-        with open(corpus_path(corpus, language_pair, split, lang_1)) as lang_1_corpus, \
-             open(corpus_path(corpus, language_pair, split, lang_2)) as lang_2_corpus, \
-             open(corpus_path(corpus, language_pair, split, 'ids')) as doc_ids:
-            data = []
-            prev_lang_1_line = ''
-            prev_lang_2_line = ''
-            prev_doc_id = None
-            for raw_lang_1_line, raw_lang_2_line, doc_id_line in zip(lang_1_corpus, lang_2_corpus, doc_ids):
-                lang_1_line = raw_lang_1_line.strip()
-                lang_2_line = raw_lang_2_line.strip()
-                doc_id = doc_id_line.split()[0]
-
-                # clear out prior context if moving to a new document
-                if doc_id != prev_doc_id:
-                    prev_lang_1_line = ''
-                    prev_lang_2_line = ''
-
-                lang_1_example = f'{prev_lang_1_line} {break_token} {lang_1_line}'
-                lang_2_example = f'{prev_lang_2_line} {break_token} {lang_2_line}'
-
-                data.append(["", lang_1_example, lang_2_example])
-
-                prev_lang_1_line = lang_1_line
-                prev_lang_2_line = lang_2_line
-                prev_doc_id = doc_id
-
-        return pd.DataFrame(data, columns=["prefix", "input_text", "target_text"])
-    if context_type == 'no-context-with-break':
-        with open(corpus_path(corpus, language_pair, split, lang_1)) as lang_1_corpus, \
-             open(corpus_path(corpus, language_pair, split, lang_2)) as lang_2_corpus:
-            data = []
-            for raw_lang_1_line, raw_lang_2_line in zip(lang_1_corpus, lang_2_corpus):
-                lang_1_line = raw_lang_1_line.strip()
-                lang_2_line = raw_lang_2_line.strip()
-
-                lang_1_example = f' {break_token} {lang_1_line}'
-                lang_2_example = f' {break_token} {lang_2_line}'
-
-                data.append(["", lang_1_example, lang_2_example])
-        
-        return pd.DataFrame(data, columns=["prefix", "input_text", "target_text"])
-    
-    if context_type == 'no-context-without-break':
-        with open(corpus_path(corpus, language_pair, split, lang_1)) as lang_1_corpus, \
-             open(corpus_path(corpus, language_pair, split, lang_2)) as lang_2_corpus:
-            data = []
-            for raw_lang_1_line, raw_lang_2_line in zip(lang_1_corpus, lang_2_corpus):
-                lang_1_line = raw_lang_1_line.strip()
-                lang_2_line = raw_lang_2_line.strip()
-
-                lang_1_example = f'{lang_1_line}'
-                lang_2_example = f'{lang_2_line}'
-
-                data.append(["", lang_1_example, lang_2_example])
-
-        return pd.DataFrame(data, columns=["prefix", "input_text", "target_text"])
-
-    if context_type == 'random-context':
-        with open(corpus_path(corpus, language_pair, split, lang_1)) as lang_1_corpus, \
-             open(corpus_path(corpus, language_pair, split, lang_2)) as lang_2_corpus:
-            lang_1_corpus_lines = [
-                raw_lang_1_line.strip() 
-                for raw_lang_1_line in lang_1_corpus.readlines()
-            ]
-            lang_2_corpus_lines = [
-                raw_lang_2_line.strip() 
-                for raw_lang_2_line in lang_2_corpus.readlines()
-            ]
-
-            data = []
-            for lang_1_line, lang_2_line in zip(lang_1_corpus_lines, lang_2_corpus_lines):
-                # select random context
-                random_index = random.randint(0, len(lang_1_corpus_lines) - 1)
-                random_lang_1_line = lang_1_corpus_lines[random_index]
-                random_lang_2_line = lang_2_corpus_lines[random_index]
-
-                lang_1_example = f'{random_lang_1_line} {break_token} {lang_1_line}'
-                lang_2_example = f'{random_lang_2_line} {break_token} {lang_2_line}'
-
-                data.append(["", lang_1_example, lang_2_example])
-        
-        return pd.DataFrame(data, columns=["prefix", "input_text", "target_text"])
 
-    raise NotImplementedError
\ No newline at end of file
+    columnar_corpus = open_columnar_corpus(corpus, language_pair, split)
+    if columnar_corpus is not None:
+        starts = np.zeros(len(columnar_corpus), dtype=bool)
+        starts[np.asarray(columnar_corpus.doc_offsets[:-1])] = True
+        return columnar_corpus.column(lang_1), columnar_corpus.column(lang_2), starts
+
+    return (
+        IndexedTextLines(corpus_path(corpus, language_pair, split, lang_1)),
+        IndexedTextLines(corpus_path(corpus, language_pair, split, lang_2)),
+        ids_document_starts(corpus_path(corpus, language_pair, split, 'ids')),
+    )
+
+# helper function to build the examples of a context type that only looks
+# back within the document (no context, N-to-N) in one sequential pass over
+# the text files, keeping only a trailing window of the previous sentences;
+# yields the same examples as context_examples
+def iter_window_examples(corpus, language_pair, split, context_type, break_token):
+    lang_1, lang_2 = language_pair.split('-')
+    num_slots, num_previous, with_break = context_slots(context_type)
+    windows = (deque(maxlen=num_previous), deque(maxlen=num_previous))
+
+    with open(corpus_path(corpus, language_pair, split, 'ids'), encoding='utf-8') as doc_ids, \
+         open(corpus_path(corpus, language_pair, split, lang_1), encoding='utf-8') as lang_1_lines, \
+         open(corpus_path(corpus, language_pair, split, lang_2), encoding='utf-8') as lang_2_lines:
+        prev_doc_id = None
+        for doc_id_line, lang_1_line, lang_2_line in zip(doc_ids, lang_1_lines, lang_2_lines):
+            # the context starts over with every document
+            doc_id = doc_id_line.split()[0]
+            if doc_id != prev_doc_id:
+                for window in windows:
+                    window.clear()
+            prev_doc_id = doc_id
+
+            lines = (lang_1_line.strip(), lang_2_line.strip())
+            texts = [
+                f' {break_token} '.join([''] * (num_slots - len(window)) + list(window) + [line]) if with_break else line
+                for window, line in zip(windows, lines)
+            ]
+            yield ["", *texts]
+
+            for window, line in zip(windows, lines):
+                window.append(line)
+
+# helper function to build the lazy examples of a context type over columns
+def context_examples(lang_1_lines, lang_2_lines, starts, context_type, break_token, seed=None):
+    indices, with_break = context_indices(context_type, starts, seed)
+    return ContextExamples(lang_1_lines, lang_2_lines, indices, break_token if with_break else None)
+
+# lazily build (prefix, input_text, target_text) examples for a context
+# type (see common/context_windows.py), rendering each example as it is
+# yielded; with shard=(index, count) only every count-th example (starting
+# at index) is yielded. text corpora are read sequentially unless the
+# context type needs random access (random context)
+def iter_preprocess(corpus, language_pair, split, context_type, break_token, seed=None, shard=(0, 1)):
+    shard_index, shard_count = shard
+
+    if context_slots(context_type) is not None and open_columnar_corpus(corpus, language_pair, split) is None:
+        for i, example in enumerate(iter_window_examples(corpus, language_pair, split, context_type, break_token)):
+            if i % shard_count == shard_index:
+                yield example
+        return
+
+    examples = context_examples(*corpus_columns(corpus, language_pair, split), context_type, break_token, seed)
+    for i in range(shard_index, len(examples), shard_count):
+        yield examples[i]
+
+@instrumented("translation preprocess", count=len)
+def preprocess(corpus, language_pair, split, context_type, break_token, seed=None):
+    data = list(iter_preprocess(corpus, language_pair, split, context_type, break_token, seed))
+
+    return examples_frame(data, corpus, language_pair, split, context_type, break_token, seed)
+
+# build the examples of several context types from a single read of the
+# corpus files; returns {context_type: dataframe}, each the same as
+# preprocess() would return for that context type
+@instrumented("translation preprocess context types", count=lambda dfs: sum(len(df) for df in dfs.values()))
+def preprocess_context_types(corpus, language_pair, split, context_types, break_token, seed=None):
+    lang_1_lines, lang_2_lines, starts = corpus_columns(corpus, language_pair, split)
+    lang_1_lines = list(lang_1_lines)
+    lang_2_lines = list(lang_2_lines)
+
+    return {
+        context_type: examples_frame(
+            list(context_examples(lang_1_lines, lang_2_lines, starts, context_type, break_token, seed)),
+            corpus, language_pair, split, context_type, break_token, seed,
+        )
+        for context_type in context_types
+    }
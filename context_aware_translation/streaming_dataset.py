@@ -0,0 +1,75 @@
+import random
+from functools import partial
+
+from torch.utils.data import IterableDataset, get_worker_info
+
+from preprocess import iter_preprocess
+
+# iterable (streaming) counterpart of simpletransformers' T5Dataset: examples
+# are read lazily from the corpus, tokenized in chunks and yielded as
+# (input_ids, attention_mask, labels) padded to max_seq_length, so training
+# never holds the corpus in memory and starts after the first chunk.
+# with several DataLoader workers each worker yields a disjoint shard of
+# the examples. examples can be shuffled within a buffer of shuffle_buffer_size
+class StreamingT5Dataset(IterableDataset):
+    def __init__(self, corpus, language_pair, split, context_type, break_token, tokenizer, max_seq_length,
+                 seed=None, shuffle_buffer_size=0, chunk_size=1000):
+        self.examples = partial(iter_preprocess, corpus, language_pair, split, context_type, break_token, seed)
+        self.tokenizer = tokenizer
+        self.max_seq_length = max_seq_length
+        self.seed = seed
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.chunk_size = chunk_size
+        self.epoch = 0
+
+    # reshuffle differently on every pass over the data
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    # helper function to tokenize a chunk of examples in one call, the same
+    # way T5Dataset does (truncated and padded to max_seq_length)
+    def encode(self, chunk):
+        source_texts = [prefix + input_text for prefix, input_text, _ in chunk]
+        target_texts = [target_text for _, _, target_text in chunk]
+
+        inputs = self.tokenizer(source_texts, max_length=self.max_seq_length, padding="max_length",
+                                truncation=True, return_tensors="pt")
+        labels = self.tokenizer(target_texts, max_length=self.max_seq_length, padding="max_length",
+                                truncation=True, return_tensors="pt").input_ids
+
+        return zip(inputs.input_ids, inputs.attention_mask, labels)
+
+    def tokenized_examples(self, shard):
+        chunk = []
+        for example in self.examples(shard=shard):
+            chunk.append(example)
+            if len(chunk) == self.chunk_size:
+                yield from self.encode(chunk)
+                chunk = []
+
+        if chunk:
+            yield from self.encode(chunk)
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        shard = (worker_info.id, worker_info.num_workers) if worker_info is not None else (0, 1)
+
+        examples = self.tokenized_examples(shard)
+        if self.shuffle_buffer_size <= 1:
+            yield from examples
+            return
+
+        # shuffle buffer: yield a random buffered example as each new one comes in
+        rng = random.Random(None if self.seed is None else f'{self.seed}-{self.epoch}-{shard[0]}')
+        buffer = []
+        for example in examples:
+            if len(buffer) < self.shuffle_buffer_size:
+                buffer.append(example)
+                continue
+
+            i = rng.randrange(len(buffer))
+            yield buffer[i]
+            buffer[i] = example
+
+        rng.shuffle(buffer)
+        yield from buffer
@@ -2,14 +2,22 @@
 # https://towardsdatascience.com/how-to-train-an-mt5-model-for-translation-with-simple-transformers-30ba5fa66c5f
 
 import os
-import subprocess
-import json
-from datetime import datetime
+import sys
 
 import torch
-from simpletransformers.t5 import T5Model, T5Args
+from torch.utils.data import DataLoader
 
-from preprocess import preprocess
+# make the shared modules at the top of the repo importable
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from preprocess import preprocess, corpus_path
+from cached_dataset import CachedT5Dataset, load_token_arrays
+from streaming_dataset import StreamingT5Dataset
+from bucketed_dataset import DynamicPaddingDataset, LengthBucketBatchSampler, DynamicPaddingCollator
+from training import train_on_dataloader, cpu_bf16_supported
+from common.experiments import start_experiment, finish_experiment, experiment_fingerprint
+from common.model_registry import StartupTimer, resolve
+from common.instrumentation import span, start_run, finish_run, enabled as instrumentation_enabled
 
 
 params = {
@@ -27,30 +35,82 @@ params = {
     "MAX_SEQ_LENGTH": 128,
     "EPOCHS": 1,
     "BATCH_SIZE": 8,
+
+    # read token ids from the on-disk token cache (tokenizing only on a cache miss)
+    "TOKEN_CACHE": True,
+
+    # stream examples from the corpus instead of building the full dataframe
+    # up front, shuffling within a buffer and tokenizing in DataLoader workers
+    "STREAMING": False,
+    "SHUFFLE_BUFFER_SIZE": 10000,
+    "DATALOADER_WORKERS": 2,
+    "WARMUP_STEPS": 2000,
+    "SEED": 42,
+
+    # batch examples of similar length together and pad each batch only to
+    # its longest example; with MAX_TOKENS, batches are capped at that many
+    # padded source plus target tokens instead of BATCH_SIZE examples
+    "DYNAMIC_PADDING": False,
+    "MAX_TOKENS": None,
+    "BUCKET_SIZE": 100000,
+
+    # train on CPU through the DataLoader training loop (with dynamic
+    # padding): gradients are accumulated over several batches per optimizer
+    # step, torch's intra-op / inter-op thread pools can be sized (None
+    # keeps torch's defaults) and the forward pass can run in bfloat16 where
+    # the CPU supports it. per-step timings go to the tensorboard logs
+    "CPU_TRAINING": False,
+    "GRADIENT_ACCUMULATION_STEPS": 1,
+    "INTRA_OP_THREADS": None,
+    "INTER_OP_THREADS": None,
+    "BF16": False,
 }
 
-# make experiment directory and save experiment params down
-date_string = datetime.now().strftime("%Y%m%d_%H%M")
-commit_string = subprocess.check_output(
-    ["git", "rev-parse", "--short", "HEAD"]).strip().decode("utf-8")
-experiment_dir = "experiments/" + date_string + "_" + commit_string
-os.mkdir(experiment_dir)
-os.mkdir(experiment_dir + "/logs")
+# time each phase of starting up (reported before training starts)
+timer = StartupTimer()
+
+# make experiment directory and save experiment params down, unless a run
+# with the same params, training data and base model already completed
+with timer.phase("start experiment"):
+    experiment_dir, status = start_experiment(
+        params,
+        experiment_fingerprint(
+            [
+                corpus_path(params["CORPUS"], params["LANGUAGE_PAIR"], split, file_type)
+                for split in ('train', 'eval')
+                for file_type in (*params["LANGUAGE_PAIR"].split('-'), 'ids')
+            ],
+            params["MODEL_NAME"],
+        ),
+    )
+if status == "completed":
+    print(f"Identical run already completed in {experiment_dir}")
+    sys.exit()
+
+# record per-stage timings (and profile) into the experiment dir when INSTRUMENT is set
+start_run(experiment_dir)
 
-# save params down
-with open(experiment_dir + "/params.json", "w") as f:
-    json.dump(params, f, indent=4)
+# size torch's thread pools before any parallel work starts
+if params["INTRA_OP_THREADS"] is not None:
+    torch.set_num_threads(params["INTRA_OP_THREADS"])
+if params["INTER_OP_THREADS"] is not None:
+    torch.set_num_interop_threads(params["INTER_OP_THREADS"])
 
-# preprocess data
-train_df = preprocess(params["CORPUS"], params["LANGUAGE_PAIR"], 'train', params["CONTEXT_TYPE"], params["BREAK_TOKEN"])
-eval_df = preprocess(params["CORPUS"], params["LANGUAGE_PAIR"], 'eval', params["CONTEXT_TYPE"], params["BREAK_TOKEN"])
+bf16 = params["BF16"] and cpu_bf16_supported()
+if params["BF16"] and not bf16:
+    print("bfloat16 is not supported on this CPU (or torch version), training in float32")
+
+# set up model; simpletransformers is only imported once a run is going
+# ahead, and the base model is loaded from its local snapshot if there is one
+with timer.phase("import simpletransformers"):
+    from simpletransformers.t5 import T5Model, T5Args
 
-# set up model
 model_args = T5Args()
 model_args.max_seq_length = params["MAX_SEQ_LENGTH"]
 model_args.train_batch_size = params["BATCH_SIZE"]
 model_args.eval_batch_size = params["BATCH_SIZE"]
 model_args.num_train_epochs = params["EPOCHS"]
+model_args.gradient_accumulation_steps = params["GRADIENT_ACCUMULATION_STEPS"]
 model_args.evaluate_during_training = True
 model_args.evaluate_during_training_steps = 10000
 model_args.use_multiprocessing = False
@@ -66,13 +126,85 @@ model_args.overwrite_output_dir = True
 model_args.preprocess_inputs = False
 model_args.num_return_sequences = 1
 model_args.tensorboard_dir = experiment_dir + "/logs"
+if params["TOKEN_CACHE"]:
+    model_args.dataset_class = CachedT5Dataset
+
+with timer.phase(f"load model {params['MODEL_NAME']}"):
+    model = T5Model(
+        params["MODEL_TYPE"],
+        resolve(params["MODEL_NAME"]),
+        args=model_args,
+        use_cuda = torch.cuda.is_available() and not params["CPU_TRAINING"]
+    )
+timer.report()
+
+if params["STREAMING"]:
+    # stream, tokenize and batch examples lazily
+    model.args.warmup_steps = params["WARMUP_STEPS"]
+    train_dataset, eval_dataset = [
+        StreamingT5Dataset(
+            params["CORPUS"],
+            params["LANGUAGE_PAIR"],
+            split,
+            params["CONTEXT_TYPE"],
+            params["BREAK_TOKEN"],
+            model.tokenizer,
+            params["MAX_SEQ_LENGTH"],
+            seed=params["SEED"],
+            shuffle_buffer_size=shuffle_buffer_size,
+        )
+        for split, shuffle_buffer_size in (('train', params["SHUFFLE_BUFFER_SIZE"]), ('eval', 0))
+    ]
+    train_dataloader = DataLoader(train_dataset, batch_size=params["BATCH_SIZE"], num_workers=params["DATALOADER_WORKERS"])
+    eval_dataloader = DataLoader(eval_dataset, batch_size=params["BATCH_SIZE"], num_workers=params["DATALOADER_WORKERS"])
+
+    # train model
+    train_on_dataloader(model, train_dataloader, eval_dataloader, bf16=bf16)
+elif params["DYNAMIC_PADDING"] or params["CPU_TRAINING"]:
+    # preprocess data
+    train_df = preprocess(params["CORPUS"], params["LANGUAGE_PAIR"], 'train', params["CONTEXT_TYPE"], params["BREAK_TOKEN"])
+    eval_df = preprocess(params["CORPUS"], params["LANGUAGE_PAIR"], 'eval', params["CONTEXT_TYPE"], params["BREAK_TOKEN"])
+
+    # batch by length and pad per batch
+    model.args.warmup_steps = params["WARMUP_STEPS"]
+    collator = DynamicPaddingCollator(model.tokenizer.pad_token_id)
+    train_dataloader, eval_dataloader = [
+        DataLoader(
+            dataset,
+            batch_sampler=LengthBucketBatchSampler(
+                *dataset.lengths(),
+                batch_size=None if params["MAX_TOKENS"] is not None else params["BATCH_SIZE"],
+                max_tokens=params["MAX_TOKENS"],
+                bucket_size=params["BUCKET_SIZE"],
+                shuffle=shuffle,
+                seed=params["SEED"],
+            ),
+            collate_fn=collator,
+            num_workers=params["DATALOADER_WORKERS"],
+        )
+        for dataset, shuffle in (
+            (DynamicPaddingDataset(model.tokenizer, train_df, params["MAX_SEQ_LENGTH"], params["TOKEN_CACHE"]), True),
+            (DynamicPaddingDataset(model.tokenizer, eval_df, params["MAX_SEQ_LENGTH"], params["TOKEN_CACHE"]), False),
+        )
+    ]
+
+    # train model
+    train_on_dataloader(model, train_dataloader, eval_dataloader, bf16=bf16)
+else:
+    # preprocess data
+    train_df = preprocess(params["CORPUS"], params["LANGUAGE_PAIR"], 'train', params["CONTEXT_TYPE"], params["BREAK_TOKEN"])
+    eval_df = preprocess(params["CORPUS"], params["LANGUAGE_PAIR"], 'eval', params["CONTEXT_TYPE"], params["BREAK_TOKEN"])
+
+    # count the (non-padding) tokens trained on, from the same token ids the
+    # training dataset is built from (read from the token cache, if enabled)
+    train_tokens = 0
+    if instrumentation_enabled():
+        token_arrays = load_token_arrays(model.tokenizer, train_df, params["MAX_SEQ_LENGTH"], params["TOKEN_CACHE"])
+        train_tokens = int(sum(token_array.lengths().sum() for token_array in token_arrays.values())) * params["EPOCHS"]
 
-model = T5Model(
-    params["MODEL_TYPE"],
-    params["MODEL_NAME"],
-    args=model_args,
-    use_cuda = torch.cuda.is_available()
-)
+    # train model
+    with span("train", examples=len(train_df) * params["EPOCHS"], tokens=train_tokens):
+        model.train_model(train_df, eval_data=eval_df)
 
-# train model
-model.train_model(train_df, eval_data=eval_df)
+finish_experiment(experiment_dir)
+finish_run()
@@ -0,0 +1,214 @@
+import contextlib
+import os
+import time
+
+import torch
+from tqdm.auto import tqdm
+
+from common.instrumentation import span
+
+# helper function to set up the same optimizer and learning rate schedule
+# simpletransformers uses for T5 by default (Adafactor, constant schedule
+# with warmup), configured from the model args; transformers is imported
+# here so train.py can finish starting up (or skip a completed run) without it
+def build_optimizer(model, args):
+    from transformers.optimization import Adafactor, get_constant_schedule_with_warmup
+
+    optimizer = Adafactor(
+        model.parameters(),
+        lr=args.learning_rate,
+        eps=args.adafactor_eps,
+        clip_threshold=args.adafactor_clip_threshold,
+        decay_rate=args.adafactor_decay_rate,
+        beta1=args.adafactor_beta1,
+        weight_decay=args.weight_decay,
+        scale_parameter=args.adafactor_scale_parameter,
+        relative_step=args.adafactor_relative_step,
+        warmup_init=args.adafactor_warmup_init,
+    )
+    scheduler = get_constant_schedule_with_warmup(optimizer, num_warmup_steps=args.warmup_steps)
+
+    return optimizer, scheduler
+
+# helper function to move a (input_ids, attention_mask, labels) batch to the
+# model's device, ignoring padding in the labels like simpletransformers does
+def batch_inputs(batch, pad_token_id, device):
+    input_ids, attention_mask, labels = (tensor.to(device) for tensor in batch)
+    labels = labels.masked_fill(labels == pad_token_id, -100)
+
+    return {"input_ids": input_ids, "attention_mask": attention_mask, "labels": labels}
+
+# compute the average loss of a model over a dataloader
+def evaluate(model, dataloader):
+    model.model.eval()
+
+    total_loss = 0.0
+    num_batches = 0
+    for batch in tqdm(dataloader, desc="Evaluating"):
+        with torch.no_grad():
+            loss = model.model(**batch_inputs(batch, model.tokenizer.pad_token_id, model.device))[0]
+        total_loss += loss.item()
+        num_batches += 1
+
+    return total_loss / num_batches
+
+# helper function to evaluate the model while training: logs the eval loss
+# and saves the model to args.best_model_dir if it has the lowest eval loss
+# so far; returns the (new) best eval loss
+def evaluate_checkpoint(model, eval_dataloader, optimizer, scheduler, tb_writer, global_step, best_eval_loss):
+    with span("evaluate"):
+        eval_loss = evaluate(model, eval_dataloader)
+    tb_writer.add_scalar("eval_loss", eval_loss, global_step)
+
+    if best_eval_loss is None or eval_loss < best_eval_loss:
+        best_eval_loss = eval_loss
+        model.save_model(model.args.best_model_dir, optimizer, scheduler, model=model.model,
+                         results={"eval_loss": eval_loss})
+
+    return best_eval_loss
+
+# helper function to check whether this CPU runs bfloat16 natively (with a
+# torch recent enough to autocast on CPU)
+def cpu_bf16_supported():
+    if not hasattr(torch, "autocast"):
+        return False
+
+    try:
+        return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except (AttributeError, RuntimeError):
+        return False
+
+# helper function to run the forward pass in bfloat16 autocast on CPU, if enabled
+def autocast(bf16):
+    return torch.autocast("cpu", dtype=torch.bfloat16) if bf16 else contextlib.nullcontext()
+
+# helper function to group consecutive batches for gradient accumulation;
+# the last group of an epoch may be smaller
+def accumulation_groups(dataloader, accumulation_steps):
+    group = []
+    for batch in dataloader:
+        group.append(batch)
+        if len(group) == accumulation_steps:
+            yield group
+            group = []
+
+    if group:
+        yield group
+
+# train a simpletransformers T5Model on batches from a DataLoader; used in
+# place of T5Model.train_model, which only accepts a dataframe and builds a
+# map-style dataset with a random sampler (so it can't consume a streaming
+# IterableDataset). checkpoints, the best model (by eval loss) and
+# tensorboard logs go where the model args say, as with train_model. the
+# model is evaluated at the end of every epoch and, with
+# args.evaluate_during_training, every args.evaluate_during_training_steps
+# optimizer steps.
+# gradients are accumulated over args.gradient_accumulation_steps batches
+# per optimizer step, optionally with the forward pass in bfloat16 autocast.
+# the time each optimizer step spends loading data, in the forward and
+# backward passes and in the optimizer is logged to tensorboard
+def train_on_dataloader(model, train_dataloader, eval_dataloader=None, bf16=False):
+    from torch.utils.tensorboard import SummaryWriter
+
+    args = model.args
+    accumulation_steps = max(args.gradient_accumulation_steps, 1)
+    model.model.to(model.device)
+
+    optimizer, scheduler = build_optimizer(model.model, args)
+    tb_writer = SummaryWriter(log_dir=args.tensorboard_dir)
+
+    global_step = 0
+    best_eval_loss = None
+    evaluated_step = None
+    evaluate_steps = args.evaluate_during_training_steps if args.evaluate_during_training else 0
+    for epoch in range(args.num_train_epochs):
+        for epoch_aware in (train_dataloader.dataset, train_dataloader.batch_sampler):
+            if hasattr(epoch_aware, "set_epoch"):
+                epoch_aware.set_epoch(epoch)
+
+        # real (non-padding) and padded tokens seen since the last log
+        real_tokens = 0
+        padded_tokens = 0
+        log_start_time = time.perf_counter()
+
+        model.model.train()
+        groups = accumulation_groups(train_dataloader, accumulation_steps)
+        progress_bar = tqdm(desc=f"Epoch {epoch + 1} of {args.num_train_epochs}", unit="step")
+        with span("train") as train_span:
+            while True:
+                step_start_time = time.perf_counter()
+                group = next(groups, None)
+                if group is None:
+                    break
+                step_times = {"data": time.perf_counter() - step_start_time, "forward": 0.0, "backward": 0.0}
+
+                step_loss = 0.0
+                for batch in group:
+                    forward_start_time = time.perf_counter()
+                    inputs = batch_inputs(batch, model.tokenizer.pad_token_id, model.device)
+                    batch_tokens = int(inputs["attention_mask"].sum()) + int((inputs["labels"] != -100).sum())
+                    real_tokens += batch_tokens
+                    train_span.add(examples=len(inputs["input_ids"]), tokens=batch_tokens)
+                    padded_tokens += inputs["input_ids"].numel() + inputs["labels"].numel()
+
+                    with autocast(bf16):
+                        loss = model.model(**inputs)[0] / len(group)
+
+                    backward_start_time = time.perf_counter()
+                    step_times["forward"] += backward_start_time - forward_start_time
+
+                    loss.backward()
+                    step_times["backward"] += time.perf_counter() - backward_start_time
+                    step_loss += loss.item()
+
+                optimizer_start_time = time.perf_counter()
+                torch.nn.utils.clip_grad_norm_(model.model.parameters(), args.max_grad_norm)
+                optimizer.step()
+                scheduler.step()
+                model.model.zero_grad()
+                step_times["optimizer"] = time.perf_counter() - optimizer_start_time
+
+                global_step += 1
+                progress_bar.update(1)
+
+                for phase, seconds in step_times.items():
+                    tb_writer.add_scalar(f"step_time/{phase}", seconds, global_step)
+
+                if global_step % args.logging_steps == 0:
+                    tb_writer.add_scalar("lr", scheduler.get_last_lr()[0], global_step)
+                    tb_writer.add_scalar("loss", step_loss, global_step)
+
+                    # throughput counts only real tokens; the padding ratio is
+                    # the fraction of computed positions that were padding
+                    elapsed = time.perf_counter() - log_start_time
+                    tb_writer.add_scalar("tokens_per_second", real_tokens / elapsed, global_step)
+                    tb_writer.add_scalar("padding_ratio", 1 - real_tokens / padded_tokens, global_step)
+                    real_tokens = 0
+                    padded_tokens = 0
+                    log_start_time = time.perf_counter()
+
+                if eval_dataloader is not None and evaluate_steps > 0 and global_step % evaluate_steps == 0:
+                    eval_start_time = time.perf_counter()
+                    best_eval_loss = evaluate_checkpoint(
+                        model, eval_dataloader, optimizer, scheduler, tb_writer, global_step, best_eval_loss)
+                    evaluated_step = global_step
+                    model.model.train()
+                    # keep evaluation out of the training throughput
+                    log_start_time += time.perf_counter() - eval_start_time
+
+        progress_bar.close()
+
+        if args.save_model_every_epoch:
+            checkpoint_dir = os.path.join(args.output_dir, f"checkpoint-{global_step}-epoch-{epoch + 1}")
+            model.save_model(checkpoint_dir, optimizer, scheduler, model=model.model)
+
+        # evaluate at the end of the epoch, unless its last step was just evaluated
+        if eval_dataloader is not None and evaluated_step != global_step:
+            best_eval_loss = evaluate_checkpoint(
+                model, eval_dataloader, optimizer, scheduler, tb_writer, global_step, best_eval_loss)
+            evaluated_step = global_step
+
+    model.save_model(args.output_dir, model=model.model)
+    tb_writer.close()
+
+    return global_step
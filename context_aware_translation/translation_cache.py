@@ -0,0 +1,113 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+from common.token_cache import file_hash
+from inference import translate
+
+# the translation cache lives at the top level of the repo, next to the token cache
+CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cache', 'translations.sqlite3')
+
+# files saved with a checkpoint that don't affect its translations
+IGNORED_CHECKPOINT_FILES = {"optimizer.pt", "scheduler.pt", "training_args.bin", "eval_results.txt"}
+
+# helper function to identify a saved checkpoint by the contents of its
+# model, config and tokenizer files
+def checkpoint_hash(model_dir):
+    sha = hashlib.sha256()
+    for file_name in sorted(os.listdir(model_dir)):
+        path = os.path.join(model_dir, file_name)
+        if file_name in IGNORED_CHECKPOINT_FILES or not os.path.isfile(path):
+            continue
+        sha.update(f'{file_name}:{file_hash(path)}\n'.encode('utf-8'))
+
+    return sha.hexdigest()
+
+# helper function to build the cache key shared by all translations from
+# one checkpoint with the same decoding settings
+def translation_key(model_dir, **decoding_params):
+    key = {
+        "checkpoint": checkpoint_hash(model_dir),
+        "decoding": decoding_params,
+    }
+
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+
+# persistent (key, source sentence) -> translation store in a SQLite file.
+# holds at most max_entries translations; when full, the least recently
+# used ones are evicted
+class TranslationCache:
+    def __init__(self, path=CACHE_PATH, max_entries=1000000):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.max_entries = max_entries
+
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS translations "
+            "(key TEXT, source TEXT, translation TEXT, last_used REAL, PRIMARY KEY (key, source))")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS translations_last_used ON translations (last_used)")
+        self.connection.commit()
+
+    # look up the cached translations of sources; returns {source: translation}
+    # for the sources found, marking them as recently used
+    def get(self, key, sources, chunk_size=500):
+        sources = list(sources)
+        found = {}
+        for i in range(0, len(sources), chunk_size):
+            chunk = sources[i:i + chunk_size]
+            rows = self.connection.execute(
+                f"SELECT source, translation FROM translations WHERE key = ? AND source IN ({','.join('?' * len(chunk))})",
+                [key, *chunk],
+            )
+            found.update(rows)
+
+        now = time.time()
+        with self.connection:
+            self.connection.executemany(
+                "UPDATE translations SET last_used = ? WHERE key = ? AND source = ?",
+                [(now, key, source) for source in found],
+            )
+
+        return found
+
+    # store {source: translation} pairs, then evict down to max_entries
+    def put(self, key, translations):
+        now = time.time()
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO translations VALUES (?, ?, ?, ?)",
+                [(key, source, translation, now) for source, translation in translations.items()],
+            )
+
+            num_entries = self.connection.execute("SELECT COUNT(*) FROM translations").fetchone()[0]
+            if num_entries > self.max_entries:
+                self.connection.execute(
+                    "DELETE FROM translations WHERE rowid IN "
+                    "(SELECT rowid FROM translations ORDER BY last_used LIMIT ?)",
+                    (num_entries - self.max_entries,),
+                )
+
+    def close(self):
+        self.connection.close()
+
+# translate source sentences (see inference.translate), decoding only the
+# distinct sentences not already in the cache under key and caching their
+# translations. the statistics also count the cache hits (sentences whose
+# translation was already cached) and the repeats of sentences translated
+# earlier in the same call
+def cached_translate(model, source_sentences, cache, key, **translate_kwargs):
+    cached = cache.get(key, set(source_sentences))
+    missing = list(dict.fromkeys(source for source in source_sentences if source not in cached))
+    cache_hits = sum(source in cached for source in source_sentences)
+
+    new_translations, statistics = translate(model, missing, **translate_kwargs)
+    cached.update(zip(missing, new_translations))
+    cache.put(key, dict(zip(missing, new_translations)))
+
+    statistics["cache_hits"] = cache_hits
+    statistics["repeated_sentences"] = len(source_sentences) - cache_hits - len(missing)
+
+    return [cached[source] for source in source_sentences], statistics
@@ -1,7 +1,15 @@
 import os
+import sys
 import json
+from contextlib import ExitStack
+from multiprocessing import Pool
 from sklearn.model_selection import train_test_split
 
+# make the shared modules at the top of the repo importable
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from common.instrumentation import span, start_run, finish_run
+
 # helper function to construct path to corpus files
 def corpus_path(language_pair, file_type, corpus_path = 'raw'):
     return f'./{corpus_path}/{language_pair}/OpenSubtitles.{language_pair}.{file_type}'
@@ -31,10 +39,9 @@ def get_unique_en_doc_ids(language_pair, corpus = 'raw'):
 # shared across multiple language pair corpuses;
 # used to construct a multi-language parallel corpus
 def identify_shared_doc_ids(language_pairs):
-    language_pair_doc_ids = [
-        get_unique_en_doc_ids(language_pair) 
-        for language_pair in language_pairs
-    ]
+    # read each language pair's id file in its own process
+    with Pool(len(language_pairs)) as pool:
+        language_pair_doc_ids = pool.map(get_unique_en_doc_ids, language_pairs)
 
     shared_doc_ids = language_pair_doc_ids[0].intersection(*language_pair_doc_ids[1:])
 
@@ -42,31 +49,45 @@ def identify_shared_doc_ids(language_pairs):
 
     return list(shared_doc_ids)
 
-# function to construct a subset of a parallel corpus, containing
-# only the specified document ids
-def construct_corpus_subset(language_pair, doc_ids, subset_path):
+# function to split a parallel corpus into subsets (e.g. train and eval)
+# by document, in a single pass over the raw files; split_index maps each
+# english document id to the name of the subset it belongs to (a hash
+# lookup per line), and documents not in the index are dropped; returns
+# the number of lines written
+def construct_corpus_splits(language_pair, split_index, corpus_name):
     lang_1, lang_2 = language_pair.split('-')
+    split_names = sorted(set(split_index.values()))
+
+    print(f'Constructing {" and ".join(split_names)} corpora for {language_pair}...')
 
-    if not os.path.isdir(f'./{subset_path}'):
-        os.mkdir(f'./{subset_path}')
+    for split_name in split_names:
+        os.makedirs(f'./{corpus_name}/{split_name}/{language_pair}', exist_ok=True)
 
-    if not os.path.isdir(f'./{subset_path}/{language_pair}'):
-        os.mkdir(f'./{subset_path}/{language_pair}')
+    with ExitStack() as stack:
+        orig_id_file = stack.enter_context(open(corpus_path(language_pair, 'ids'), 'r'))
+        orig_lang_1_file = stack.enter_context(open(corpus_path(language_pair, lang_1), 'r'))
+        orig_lang_2_file = stack.enter_context(open(corpus_path(language_pair, lang_2), 'r'))
 
-    with open(corpus_path(language_pair, 'ids'), 'r') as orig_id_file, \
-         open(corpus_path(language_pair, lang_1), 'r') as orig_lang_1_file, \
-         open(corpus_path(language_pair, lang_2), 'r') as orig_lang_2_file, \
-         open(corpus_path(language_pair, 'ids', subset_path), 'w') as subset_id_file, \
-         open(corpus_path(language_pair, lang_1, subset_path), 'w') as subset_lang_1_file, \
-         open(corpus_path(language_pair, lang_2, subset_path), 'w') as subset_lang_2_file:
+        subset_files = {
+            split_name: [
+                stack.enter_context(open(corpus_path(language_pair, file_type, f'{corpus_name}/{split_name}'), 'w'))
+                for file_type in ('ids', lang_1, lang_2)
+            ]
+            for split_name in split_names
+        }
 
+        num_lines = 0
         for id_line, lang_1_line, lang_2_line in zip(orig_id_file, orig_lang_1_file, orig_lang_2_file):
-            en_doc_id = get_en_doc_id(id_line)
+            split_name = split_index.get(get_en_doc_id(id_line))
 
-            if en_doc_id in doc_ids:
+            if split_name is not None:
+                subset_id_file, subset_lang_1_file, subset_lang_2_file = subset_files[split_name]
                 subset_id_file.write(id_line)
                 subset_lang_1_file.write(lang_1_line)
                 subset_lang_2_file.write(lang_2_line)
+                num_lines += 1
+
+    return num_lines
 
 # construct a parallel corpus that includes identical content for all
 # language_pairs, one for each language pair (since the same document
@@ -78,7 +99,8 @@ def construct_multi_language_parallel_corpus(language_pairs, corpus_name):
         print('No train / eval doc id split provided, identifying docs shared by all language pairs and making new split.')
         
         # select only documents that exist in all language pairs
-        corpus_doc_ids = identify_shared_doc_ids(language_pairs)
+        with span("identify shared documents"):
+            corpus_doc_ids = identify_shared_doc_ids(language_pairs)
 
         # split docs into train and eval sets, write them down
         train_corpus_doc_ids, eval_corpus_doc_ids = train_test_split(corpus_doc_ids, test_size = 0.2)
@@ -99,13 +121,21 @@ def construct_multi_language_parallel_corpus(language_pairs, corpus_name):
         with open(f'./{corpus_name}/eval_doc_ids.json', 'r') as eval_id_file:
             eval_corpus_doc_ids = json.load(eval_id_file)
 
-    # construct actual train and eval corpuses for each language pair
-    for language_pair in language_pairs:
-        print(f'Constructing train corpus for {language_pair}...')
-        construct_corpus_subset(language_pair, train_corpus_doc_ids, f'{corpus_name}/train')
-        print(f'Constructing eval corpus for {language_pair}...')
-        construct_corpus_subset(language_pair, eval_corpus_doc_ids, f'{corpus_name}/eval')
+    # index which split each document belongs to
+    split_index = {doc_id: 'train' for doc_id in train_corpus_doc_ids}
+    split_index.update({doc_id: 'eval' for doc_id in eval_corpus_doc_ids})
+
+    # construct actual train and eval corpuses for each language pair,
+    # one language pair per process
+    with span("construct corpus splits") as construct_span, Pool(len(language_pairs)) as pool:
+        construct_span.add(examples=sum(pool.starmap(construct_corpus_splits, [
+            (language_pair, split_index, corpus_name)
+            for language_pair in language_pairs
+        ])))
 
 
 if __name__ == "__main__":
+    # record per-stage timings (and profile) next to the corpus when INSTRUMENT is set
+    start_run('./four_way_parallel_corpus')
     construct_multi_language_parallel_corpus(['en-ja', 'en-es', 'en-fr'], 'four_way_parallel_corpus')
+    finish_run()
@@ -0,0 +1,32 @@
+import os
+import shutil
+import sys
+
+# make the shared modules at the top of the repo importable
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from common.columnar_corpus import convert_corpus, columnar_up_to_date
+from construct_four_way_parallel_corpus import corpus_path
+
+# convert the (lang_1, lang_2, ids) text files of each language pair in a
+# corpus directory into the memory-mapped columnar format that preprocess()
+# reads from; conversions that are newer than their text files are kept
+def convert_corpus_dir(language_pairs, corpus_dir):
+    for language_pair in language_pairs:
+        lang_1, lang_2 = language_pair.split('-')
+        text_paths = [corpus_path(language_pair, file_type, corpus_dir) for file_type in (lang_1, lang_2, 'ids')]
+        columnar_path = corpus_path(language_pair, 'columnar', corpus_dir)
+
+        if columnar_up_to_date(columnar_path, text_paths):
+            print(f'{columnar_path} is up to date, skipping.')
+            continue
+        if os.path.isdir(columnar_path):
+            shutil.rmtree(columnar_path)
+
+        print(f'Converting {corpus_dir} {language_pair} corpus to columnar format...')
+        convert_corpus(*text_paths, columnar_path, (lang_1, lang_2))
+
+
+if __name__ == "__main__":
+    for split in ['train', 'eval']:
+        convert_corpus_dir(['en-ja', 'en-es', 'en-fr'], f'four_way_parallel_corpus/{split}')
@@ -1,42 +1,170 @@
-from tqdm import tqdm
+import hashlib
+import json
+import os
+import sys
+from array import array
+from multiprocessing import Pool
 
-from construct_four_way_parallel_corpus import get_unique_en_doc_ids, corpus_path
+import numpy as np
+
+# make the shared modules at the top of the repo importable
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from common.experiments import file_signature
+from construct_four_way_parallel_corpus import get_en_doc_id, corpus_path
 
 language_pairs = ['en-ja', 'en-fr', 'en-es']
 
-train_doc_count = get_unique_en_doc_ids('en-ja', 'four_way_parallel_corpus/train')
-print('Train data statistics:')
-print(f'Documents: {len(train_doc_count)}')
-for pair in language_pairs:
-    with open(corpus_path(pair, 'en', 'four_way_parallel_corpus/train'), 'r') as f:
-        print(f'{pair} has {len(f.readlines())} sentences.')
-
-print('')
-print('')
-
-eval_doc_count = get_unique_en_doc_ids('en-ja', 'four_way_parallel_corpus/eval')
-print('Eval data statistics:')
-print(f'Documents: {len(eval_doc_count)}')
-for pair in language_pairs:
-    with open(corpus_path(pair, 'en', 'four_way_parallel_corpus/eval'), 'r') as f:
-        print(f'{pair} has {len(f.readlines())} sentences.')
-
-print('')
-print('')
-with open(corpus_path('en-ja', 'en', 'four_way_parallel_corpus/train'), 'r') as en_ja_f, \
-     open(corpus_path('en-fr', 'en', 'four_way_parallel_corpus/train'), 'r') as en_fr_f, \
-     open(corpus_path('en-es', 'en', 'four_way_parallel_corpus/train'), 'r') as en_es_f: \
-    
-    en_ja_lines = en_ja_f.readlines()
-    en_fr_lines = en_fr_f.readlines()
-    en_es_lines = en_es_f.readlines()
-
-    total = 0
-    shared = 0
-    for en_line in tqdm(en_es_lines):
-        total += 1
-        if en_line in en_ja_lines and en_line in en_fr_lines:
-            shared += 1
-
-print(f'Of the {total} train lines in en-es, {shared} also occur in en-fr and en-ja')
+# helper function to turn a list of counts into a sparse {value: frequency} histogram
+def histogram(values):
+    counts = np.bincount(np.asarray(values, dtype=np.int64)) if len(values) > 0 else np.zeros(0, dtype=np.int64)
+    return {str(value): int(count) for value, count in enumerate(counts) if count > 0}
+
+# helper function to hash a line (without its newline) to 64 bits for set membership
+def line_hash(line):
+    return int.from_bytes(hashlib.blake2b(line.rstrip('\n').encode('utf-8'), digest_size=8).digest(), 'little')
+
+# compute the statistics of one language file of a corpus (and its id file)
+# in a single streaming pass: sentence and document counts, per-document
+# sentence counts and per-sentence (whitespace) token counts, plus a
+# sha256 of the (decoded) contents of both files. the 64-bit hash of every
+# line is saved to hashes_dir, named by the content hash, so overlaps
+# between files can be counted later without re-reading them; returns the
+# statistics, the content hashes and the path of the line hashes
+def language_file_statistics(text_path, ids_path, hashes_dir):
+    line_hashes = array('Q')
+    token_counts = array('i')
+    character_count = 0
+    document_sentence_counts = []
+    doc_ids = set()
+    text_sha = hashlib.sha256()
+    ids_sha = hashlib.sha256()
+
+    with open(text_path, 'r') as text_file, open(ids_path, 'r') as id_file:
+        prev_doc_id = None
+        for line, id_line in zip(text_file, id_file):
+            text_sha.update(line.encode('utf-8'))
+            ids_sha.update(id_line.encode('utf-8'))
+            line_hashes.append(line_hash(line))
+            token_counts.append(len(line.split()))
+            character_count += len(line.strip())
+
+            doc_id = get_en_doc_id(id_line)
+            doc_ids.add(doc_id)
+            if doc_id != prev_doc_id:
+                document_sentence_counts.append(0)
+            document_sentence_counts[-1] += 1
+            prev_doc_id = doc_id
+
+        # lines past the end of the shorter file still change the contents
+        for line in text_file:
+            text_sha.update(line.encode('utf-8'))
+        for id_line in id_file:
+            ids_sha.update(id_line.encode('utf-8'))
+
+    content_hash = [text_sha.hexdigest(), ids_sha.hexdigest()]
+    hashes_path = os.path.join(hashes_dir, f'{content_hash[0]}.npy')
+    np.save(hashes_path, np.frombuffer(line_hashes, dtype=np.uint64))
+
+    statistics = {
+        "sentences": len(token_counts),
+        "documents": len(doc_ids),
+        "tokens": int(sum(token_counts)),
+        "characters": character_count,
+        "sentences_per_document": histogram(document_sentence_counts),
+        "tokens_per_sentence": histogram(token_counts),
+    }
+
+    return statistics, content_hash, hashes_path
+
+# helper function for pool workers
+def compute_file_statistics(job):
+    key, text_path, ids_path, hashes_dir = job
+    return (key, *language_file_statistics(text_path, ids_path, hashes_dir))
+
+# count the lines of a file that also occur in every one of the other files
+# (by line hash); vectorized set membership over the saved hash arrays
+def count_shared_lines(hashes, other_hashes):
+    shared = np.ones(len(hashes), dtype=bool)
+    for other in other_hashes:
+        shared &= np.isin(hashes, other)
+
+    return int(shared.sum())
+
+# compute (or update) statistics for every language file of every split of
+# a corpus. results are cached in {corpus}/corpus_statistics.json; on a
+# rerun only files whose size or modification time changed are read again
+# (in parallel, one file per process, hashing them in the same pass), and
+# overlaps are recomputed from cached line hashes
+def corpus_statistics(corpus_name, splits, language_pairs):
+    statistics_path = f'./{corpus_name}/corpus_statistics.json'
+    hashes_dir = f'./{corpus_name}/.statistics'
+    os.makedirs(hashes_dir, exist_ok=True)
+
+    cached_files = {}
+    if os.path.isfile(statistics_path):
+        with open(statistics_path, 'r') as f:
+            cached_files = json.load(f)["files"]
+
+    files = {}
+    jobs = []
+    for split in splits:
+        for language_pair in language_pairs:
+            ids_path = corpus_path(language_pair, 'ids', f'{corpus_name}/{split}')
+            for language in language_pair.split('-'):
+                key = f'{split}/{language_pair}/{language}'
+                text_path = corpus_path(language_pair, language, f'{corpus_name}/{split}')
+                signature = [file_signature(text_path), file_signature(ids_path)]
+
+                cached = cached_files.get(key)
+                if cached is not None and (cached["signature"] != signature or not os.path.isfile(cached["hashes"])):
+                    cached = None
+
+                if cached is not None:
+                    files[key] = cached
+                else:
+                    files[key] = {"signature": signature, "sha256": None, "hashes": None, "statistics": None}
+                    jobs.append((key, text_path, ids_path, hashes_dir))
+
+    if jobs:
+        print(f'Computing statistics for {len(jobs)} changed or new files...')
+        with Pool(min(len(jobs), os.cpu_count() or 1)) as pool:
+            for key, file_statistics, content_hash, hashes_path in pool.imap_unordered(compute_file_statistics, jobs):
+                files[key].update({"sha256": content_hash, "hashes": hashes_path, "statistics": file_statistics})
+
+    # english sentences of each language pair that also occur in the other pairs
+    overlaps = {}
+    for split in splits:
+        en_hashes = {
+            language_pair: np.load(files[f'{split}/{language_pair}/en']["hashes"])
+            for language_pair in language_pairs
+        }
+        for language_pair in language_pairs:
+            others = [other for other in language_pairs if other != language_pair]
+            overlaps[f'{split}/{language_pair}'] = {
+                "shared_with": others,
+                "sentences": len(en_hashes[language_pair]),
+                "shared_sentences": count_shared_lines(en_hashes[language_pair], [en_hashes[other] for other in others]),
+            }
+
+    statistics = {"files": files, "overlaps": overlaps}
+    with open(statistics_path, 'w') as f:
+        json.dump(statistics, f, indent=4)
+
+    return statistics
+
+
+if __name__ == "__main__":
+    statistics = corpus_statistics('four_way_parallel_corpus', ['train', 'eval'], language_pairs)
+
+    for split in ['train', 'eval']:
+        print(f'{split.capitalize()} data statistics:')
+        print(f'Documents: {statistics["files"][f"{split}/en-ja/en"]["statistics"]["documents"]}')
+        for pair in language_pairs:
+            print(f'{pair} has {statistics["files"][f"{split}/{pair}/en"]["statistics"]["sentences"]} sentences.')
+
+        print('')
+        print('')
 
+    overlap = statistics["overlaps"]["train/en-es"]
+    print(f'Of the {overlap["sentences"]} train lines in en-es, {overlap["shared_sentences"]} also occur in en-fr and en-ja')
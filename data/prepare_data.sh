@@ -23,4 +23,7 @@ downloadOpenSubtitlesCorpus "en-fr"
 downloadOpenSubtitlesCorpus "en-es"
 
 # assemble a four way corpus with identical documents for each language
-python construct_four_way_parallel_corpus.py
\ No newline at end of file
+python construct_four_way_parallel_corpus.py
+
+# convert the four way corpus into a memory-mapped columnar format
+python convert_to_columnar.py
\ No newline at end of file
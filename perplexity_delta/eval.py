@@ -1,115 +1,202 @@
-import math
 import os
-import subprocess
-import json
-from datetime import datetime
+import sys
 
+import numpy as np
 import torch
-from transformers import GPT2LMHeadModel, AutoModelForCausalLM, GPT2TokenizerFast, T5TokenizerFast, AutoTokenizer
-from tqdm import tqdm
 
-from preprocess import preprocess
+# make the shared modules at the top of the repo importable
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from preprocess import preprocess_documents, document_examples, corpus_files
+from scoring import encode_examples, score_encoded_examples, check_against_two_pass, cached_line_encodings, \
+    sample_pooled_perplexities
+from streaming import score_documents
+from language_models import language_models, load_language_model
+from metrics import stored_perplexity_metrics
+from result_store import ResultStore, document_chunks
+from common.experiments import start_experiment, finish_experiment, experiment_fingerprint
+from common.model_registry import StartupTimer
+from common.quantization import quantize_model, compare_quantized
+from common.instrumentation import span, start_run, finish_run
 
 device = "cuda" if torch.cuda.is_available() else "cpu"
 
 language = "fr"
 
-language_models = {
-    "en": "gpt2-medium",
-    "ja": "rinna/japanese-gpt2-medium",
-    "es": "DeepESP/gpt2-spanish-medium",
-    "fr": 'antoiloui/belgpt2'
-}
-
 params = {
     "LANGUAGE": language,
     "MODEL": language_models[language],
+
+    # scoring: examples per forward pass, or a cap on padded tokens per
+    # forward pass (None to only use the batch size)
+    "BATCH_SIZE": 16,
+    "MAX_TOKENS": None,
+    # how examples are scored: "batched" (with- and without-context
+    # sequences bucketed separately), "packed" (both in one pass) or
+    # "streaming" (one stream of cached keys / values per sentence and its
+    # following context; supports any CONTEXT_SIZE)
+    "SCORING_MODE": "packed",
+    # number of previous sentences used as context (streaming mode only)
+    "CONTEXT_SIZE": 1,
+    # number of examples re-scored with the two-pass reference to check
+    # the batched results (0 to skip), and the allowed relative difference
+    "VERIFY_SAMPLE_SIZE": 100,
+    "VERIFY_TOLERANCE": 1e-4,
+    # read token ids from the on-disk token cache (tokenizing only on a cache miss)
+    "TOKEN_CACHE": True,
+    # number of sentences (rounded up to whole documents) scored between
+    # writes of per-example results to the experiment dir
+    "CHUNK_SIZE": 10000,
+    # score with dynamic int8 quantization of the model's Linear layers (CPU
+    # only). a random sample of examples is scored with both the fp32 and the
+    # quantized model first, and the run stops if quantization moves the
+    # sample's perplexity (pooled over every scored token) by more than the
+    # relative threshold
+    "QUANTIZE": False,
+    "QUANTIZATION_SAMPLE_SIZE": 200,
+    "QUANTIZATION_MAX_DRIFT": 0.01,
 }
 
-# make experiment directory and save experiment params down
-date_string = datetime.now().strftime("%Y%m%d_%H%M")
-commit_string = subprocess.check_output(
-    ["git", "rev-parse", "--short", "HEAD"]).strip().decode("utf-8")
-experiment_dir = "experiments/" + date_string + "_" + commit_string
-os.mkdir(experiment_dir)
-os.mkdir(experiment_dir + "/logs")
-
-# save params down
-with open(experiment_dir + "/params.json", "w") as f:
-    json.dump(params, f, indent=4)
-
-# load pre-trained causal language model
-if params["LANGUAGE"] == "en":
-    tokenizer = GPT2TokenizerFast.from_pretrained(params["MODEL"])
-    model = GPT2LMHeadModel.from_pretrained(params["MODEL"]).to(device)
-elif params["LANGUAGE"] == "ja":
-    tokenizer = T5TokenizerFast.from_pretrained(params["MODEL"])
-    tokenizer.do_lower_case = True  # due to some bug of tokenizer config loading
-    model = AutoModelForCausalLM.from_pretrained(params["MODEL"]).to(device)
-else:
-    tokenizer = AutoTokenizer.from_pretrained(params["MODEL"])
-    model = AutoModelForCausalLM.from_pretrained(params["MODEL"]).to(device)
+# quantized models only run on CPU
+if params["QUANTIZE"]:
+    device = "cpu"
+
+# time each phase of starting up (reported before scoring starts)
+timer = StartupTimer()
+
+# make experiment directory and save experiment params down; a run with
+# the same params, eval data and model that already completed isn't
+# repeated, and one that was interrupted is resumed in its own directory
+# (scoring continues after the last stored chunk)
+with timer.phase("start experiment"):
+    experiment_dir, status = start_experiment(
+        params,
+        experiment_fingerprint(corpus_files('four_way_parallel_corpus', params["LANGUAGE"], 'eval'), params["MODEL"]),
+        resume_incomplete=True,
+    )
+if status == "completed":
+    print(f"Identical run already completed in {experiment_dir}")
+    sys.exit()
+print(f"{'Resuming' if status == 'resumed' else 'Starting'} run in {experiment_dir}")
+
+# record per-stage timings (and profile) into the experiment dir when INSTRUMENT is set
+start_run(experiment_dir)
+
+# load pre-trained causal language model (from its local snapshot if there is one)
+tokenizer, model = load_language_model(params["MODEL"], device, timer)
 
 # compute perplexity delta on selected corpus
-examples = preprocess('four_way_parallel_corpus', params["LANGUAGE"], 'eval')
-
-perplexities_with_context = []
-perplexities_without_context =[]
-perplexity_deltas = []
-percent_perplexity_deltas = []
-for i in tqdm(range(len(examples))):
-    context_sentence, target_sentence = examples[i]
-    context_encoding = tokenizer(context_sentence).input_ids
-    target_encoding = tokenizer(target_sentence).input_ids
-
-    # compute perplexity with context
-    input_ids_with_context = torch.tensor([[*context_encoding, *target_encoding]]).to(device)
-    target_ids_with_context = input_ids_with_context.clone()
-    # ignore loss from context sentence tokens
-    target_ids_with_context[:,:-len(target_encoding)] = -100
-
-    with torch.no_grad():
-        loss_with_context = model(input_ids_with_context, labels=target_ids_with_context)[0]
-        # perplexity is the exponentiation of the cross-entropy loss
-        perplexity_with_context = torch.exp(loss_with_context).item()
-
-    # compute perplexity without context
-    input_ids_without_context = torch.tensor([[*target_encoding]]).to(device)
-    target_ids_without_context = input_ids_without_context.clone()
-
-    with torch.no_grad():
-        loss_without_context = model(input_ids_without_context, labels=target_ids_without_context)[0]
-        # perplexity is the exponentiation of the cross-entropy loss
-        perplexity_without_context = torch.exp(loss_without_context).item()
-
-    if math.isfinite(perplexity_with_context) and math.isfinite(perplexity_without_context):
-        perplexities_with_context.append(perplexity_with_context)
-        perplexities_without_context.append(perplexity_without_context)
-
-        perplexity_deltas.append(perplexity_without_context - perplexity_with_context)
-        percent_perplexity_deltas.append((perplexity_without_context - perplexity_with_context) / perplexity_without_context)
-
-def corpus_perplexity(perplexities):
-    log_perplexities = [math.log(perplexity) for perplexity in perplexities]
-    average_log_perplexity = sum(log_perplexities) / len(log_perplexities)
-    
-    return math.exp(average_log_perplexity)
-
-corpus_perplexity_with_context = corpus_perplexity(perplexities_with_context)
-corpus_perplexity_without_context = corpus_perplexity(perplexities_without_context)
-average_perplexity_with_context = sum(perplexities_with_context) / len(perplexities_with_context)
-average_perplexity_without_context = sum(perplexities_without_context) / len(perplexities_without_context)
-average_perplexity_deltas = sum(perplexity_deltas) / len(perplexity_deltas)
-average_percent_perplexity_deltas = sum(percent_perplexity_deltas) / len(percent_perplexity_deltas)
+with timer.phase("preprocess"):
+    documents = preprocess_documents('four_way_parallel_corpus', params["LANGUAGE"], 'eval')
+    examples = document_examples(documents)
+examples_corpus_files = corpus_files('four_way_parallel_corpus', params["LANGUAGE"], 'eval') if params["TOKEN_CACHE"] else None
+
+with timer.phase("tokenize"):
+    if params["SCORING_MODE"] == "streaming":
+        line_encodings = None
+        if examples_corpus_files is not None:
+            line_encodings = cached_line_encodings(
+                tokenizer, [sentence for _, sentence in examples], examples_corpus_files)["sentences"]
+    else:
+        context_encodings, target_encodings = encode_examples(tokenizer, examples, examples_corpus_files)
+timer.report()
+
+quantization_report = None
+if params["QUANTIZE"]:
+    # compare the quantized model against the fp32 one on a sample before scoring with it
+    quantized_model = quantize_model(model)
+    sample_perplexities = [
+        sample_pooled_perplexities(
+            scoring_model,
+            tokenizer,
+            examples,
+            sample_size=params["QUANTIZATION_SAMPLE_SIZE"],
+            batch_size=params["BATCH_SIZE"],
+            max_tokens=params["MAX_TOKENS"],
+            device=device,
+        )
+        for scoring_model in (model, quantized_model)
+    ]
+    (reference_with, reference_without, reference_seconds), (quantized_with, quantized_without, quantized_seconds) = \
+        sample_perplexities
+    quantization_report = compare_quantized(
+        {
+            "pooled_perplexity_with_context": (reference_with, quantized_with),
+            "pooled_perplexity_without_context": (reference_without, quantized_without),
+        },
+        reference_seconds,
+        quantized_seconds,
+        model,
+        quantized_model,
+        params["QUANTIZATION_MAX_DRIFT"],
+    )
+    model = quantized_model
+
+# per-example results are appended to the store chunk by chunk, so a crashed
+# run loses at most one chunk
+store = ResultStore(experiment_dir + "/examples")
+num_completed = store.num_completed()
+for start, chunk in document_chunks(documents, params["CHUNK_SIZE"]):
+    end = start + sum(len(sentences) for _, sentences in chunk)
+    if end <= num_completed:
+        continue
+
+    with span("perplexity scoring") as scoring_span:
+        if params["SCORING_MODE"] == "streaming":
+            # tokenize each sentence once, carrying context forward through each document
+            losses_with_context, losses_without_context, token_counts = score_documents(
+                model,
+                tokenizer,
+                chunk,
+                context_size=params["CONTEXT_SIZE"],
+                device=device,
+                line_encodings=line_encodings,
+                first_line=start,
+                return_token_counts=True,
+                return_losses=True,
+            )
+        else:
+            # score examples in padded, length-bucketed batches
+            losses_with_context, losses_without_context = score_encoded_examples(
+                model,
+                context_encodings[start:end],
+                target_encodings[start:end],
+                batch_size=params["BATCH_SIZE"],
+                max_tokens=params["MAX_TOKENS"],
+                device=device,
+                packed=params["SCORING_MODE"] == "packed",
+                return_losses=True,
+            )
+            token_counts = [
+                (len(context_encoding), len(target_encoding))
+                for context_encoding, target_encoding in zip(context_encodings[start:end], target_encodings[start:end])
+            ]
+        scoring_span.add(examples=end - start, tokens=sum(sum(counts) for counts in token_counts))
+
+    doc_ids = [doc_id for doc_id, sentences in chunk for _ in sentences]
+    store.append(start, doc_ids, token_counts, losses_with_context, losses_without_context)
+
+results = store.load()
+
+# make sure batching / streaming didn't change the results; the reference
+# only exists for a single context sentence. quantized scores depend
+# slightly on what is batched together, so they are checked to the drift threshold
+if params["VERIFY_SAMPLE_SIZE"] > 0 and (params["SCORING_MODE"] != "streaming" or params["CONTEXT_SIZE"] == 1):
+    check_against_two_pass(
+        model,
+        tokenizer,
+        examples,
+        np.exp(results["loss_with_context"]).tolist(),
+        np.exp(results["loss_without_context"]).tolist(),
+        sample_size=params["VERIFY_SAMPLE_SIZE"],
+        tolerance=max(params["VERIFY_TOLERANCE"], params["QUANTIZATION_MAX_DRIFT"]) if params["QUANTIZE"]
+        else params["VERIFY_TOLERANCE"],
+        device=device,
+    )
 
 # save results
-# save params down
-with open(experiment_dir + "/results.json", "w") as f:
-    json.dump({
-        "CORPUS_PERPLEXITY_WITH_CONTEXT": corpus_perplexity_with_context,
-        "CORPUS_PERPLEXITY_WITHOUT_CONTEXT": corpus_perplexity_without_context,
-        "AVERAGE_PERPLEXITY_WITH_CONTEXT": average_perplexity_with_context,
-        "AVERAGE_PERPLEXITY_WITHOUT_CONTEXT": average_perplexity_without_context,
-        "AVERAGE_PERPLEXITY_DELTA": average_perplexity_deltas,
-        "AVERAGE_PERCENT_PERPLEXITY_DELTA": average_percent_perplexity_deltas,
-    }, f, indent=4)
+metrics = stored_perplexity_metrics(results)
+if quantization_report is not None:
+    metrics["QUANTIZATION"] = quantization_report
+finish_experiment(experiment_dir, metrics)
+finish_run()
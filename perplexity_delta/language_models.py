@@ -0,0 +1,18 @@
+from common.model_registry import load_tokenizer, load_model
+
+# pre-trained causal language model used for each language (the classes to
+# load each one with, and any tokenizer fixes, are in common/model_registry.py)
+language_models = {
+    "en": "gpt2-medium",
+    "ja": "rinna/japanese-gpt2-medium",
+    "es": "DeepESP/gpt2-spanish-medium",
+    "fr": 'antoiloui/belgpt2'
+}
+
+# load the tokenizer and pre-trained causal language model of a language
+# (see language_models), from its local snapshot if there is one
+def load_language_model(model_name, device, timer=None):
+    tokenizer = load_tokenizer(model_name, timer)
+    model = load_model(model_name, device, timer)
+
+    return tokenizer, model
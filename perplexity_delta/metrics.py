@@ -0,0 +1,35 @@
+import numpy as np
+
+def corpus_perplexity(perplexities):
+    return float(np.exp(np.mean(np.log(perplexities))))
+
+# aggregate per-example perplexities (in corpus order) into the metrics
+# saved in results.json; examples with a non-finite perplexity are skipped.
+# medians are included since a few huge perplexities dominate the averages
+def perplexity_metrics(all_perplexities_with_context, all_perplexities_without_context):
+    all_perplexities_with_context = np.asarray(all_perplexities_with_context, dtype=np.float64)
+    all_perplexities_without_context = np.asarray(all_perplexities_without_context, dtype=np.float64)
+
+    finite = np.isfinite(all_perplexities_with_context) & np.isfinite(all_perplexities_without_context)
+    perplexities_with_context = all_perplexities_with_context[finite]
+    perplexities_without_context = all_perplexities_without_context[finite]
+
+    perplexity_deltas = perplexities_without_context - perplexities_with_context
+    percent_perplexity_deltas = perplexity_deltas / perplexities_without_context
+
+    return {
+        "CORPUS_PERPLEXITY_WITH_CONTEXT": corpus_perplexity(perplexities_with_context),
+        "CORPUS_PERPLEXITY_WITHOUT_CONTEXT": corpus_perplexity(perplexities_without_context),
+        "AVERAGE_PERPLEXITY_WITH_CONTEXT": float(np.mean(perplexities_with_context)),
+        "AVERAGE_PERPLEXITY_WITHOUT_CONTEXT": float(np.mean(perplexities_without_context)),
+        "AVERAGE_PERPLEXITY_DELTA": float(np.mean(perplexity_deltas)),
+        "AVERAGE_PERCENT_PERPLEXITY_DELTA": float(np.mean(percent_perplexity_deltas)),
+        "MEDIAN_PERPLEXITY_WITH_CONTEXT": float(np.median(perplexities_with_context)),
+        "MEDIAN_PERPLEXITY_WITHOUT_CONTEXT": float(np.median(perplexities_without_context)),
+        "MEDIAN_PERPLEXITY_DELTA": float(np.median(perplexity_deltas)),
+        "MEDIAN_PERCENT_PERPLEXITY_DELTA": float(np.median(percent_perplexity_deltas)),
+    }
+
+# helper function to compute the metrics of the examples in a ResultStore
+def stored_perplexity_metrics(results):
+    return perplexity_metrics(np.exp(results["loss_with_context"]), np.exp(results["loss_without_context"]))
@@ -1,26 +1,79 @@
+from common.columnar_corpus import ColumnarCorpus, columnar_up_to_date
+from common.context_windows import document_starts, previous_sentence_windows
+from common.instrumentation import instrumented
+
 # helper function to construct path to corpus files
 def corpus_path(corpus, language_pair, split, file_type):
     return f'../data/{corpus}/{split}/{language_pair}/OpenSubtitles.{language_pair}.{file_type}'
 
-def preprocess(corpus_name, language, split):
+# helper function to iterate over the stripped (line, doc id) pairs of a
+# language's corpus; read lazily from memory maps when an up-to-date
+# columnar version exists (see data/convert_to_columnar.py), otherwise
+# from the text files
+def corpus_lines(corpus_name, language, split):
     language_pair = f'en-{language}' if language != 'en' else 'en-ja'
 
+    columnar_path = corpus_path(corpus_name, language_pair, split, 'columnar')
+    text_paths = [corpus_path(corpus_name, language_pair, split, file_type) for file_type in (*language_pair.split('-'), 'ids')]
+    if columnar_up_to_date(columnar_path, text_paths):
+        columnar_corpus = ColumnarCorpus(columnar_path)
+        yield from zip(columnar_corpus.column(language), columnar_corpus.iter_doc_ids())
+        return
+
     with open(corpus_path(corpus_name, language_pair, split, language)) as corpus, \
          open(corpus_path(corpus_name, language_pair, split, 'ids')) as doc_ids:
-        data = []
-        prev_line = ''
-        prev_doc_id = None
         for raw_line, doc_id_line in zip(corpus, doc_ids):
-            line = raw_line.strip()
-            doc_id = doc_id_line.split()[0]
+            yield raw_line.strip(), doc_id_line.split()[0]
 
-            # clear out prior context if moving to a new document
-            if doc_id != prev_doc_id:
-                prev_line = ''
+# helper function to list the corpus files examples are built from
+def corpus_files(corpus_name, language, split):
+    language_pair = f'en-{language}' if language != 'en' else 'en-ja'
 
-            data.append([prev_line, line])
+    return [
+        corpus_path(corpus_name, language_pair, split, language),
+        corpus_path(corpus_name, language_pair, split, 'ids'),
+    ]
+
+@instrumented("perplexity preprocess", count=len)
+def preprocess(corpus_name, language, split):
+    lines = []
+    doc_ids = []
+    for line, doc_id in corpus_lines(corpus_name, language, split):
+        lines.append(line)
+        doc_ids.append(doc_id)
 
+    # the previous sentence of the same document is the context (empty at
+    # the start of a document)
+    context_indices = previous_sentence_windows(document_starts(doc_ids), 1)[:, 0].tolist()
+
+    return [[lines[j] if j >= 0 else '', line] for j, line in zip(context_indices, lines)]
+
+# group the corpus into documents (in corpus order), each a doc id and
+# the list of its sentences; used to stream through a document while
+# carrying context forward
+@instrumented("perplexity preprocess documents", count=lambda documents: sum(len(sentences) for _, sentences in documents))
+def preprocess_documents(corpus_name, language, split):
+    documents = []
+    prev_doc_id = None
+    for line, doc_id in corpus_lines(corpus_name, language, split):
+        # start a new document when the doc id changes
+        if doc_id != prev_doc_id:
+            documents.append((doc_id, []))
+
+        documents[-1][1].append(line)
+
+        prev_doc_id = doc_id
+
+    return documents
+
+# helper function to turn documents back into [context, target] examples,
+# exactly as preprocess() builds them from the corpus
+def document_examples(documents):
+    data = []
+    for _, sentences in documents:
+        prev_line = ''
+        for line in sentences:
+            data.append([prev_line, line])
             prev_line = line
-            prev_doc_id = doc_id
 
     return data
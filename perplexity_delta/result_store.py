@@ -0,0 +1,102 @@
+import glob
+import os
+
+import numpy as np
+
+# per-example results of an eval run, stored as a directory of columnar
+# chunk files (chunk_{start}_{end}.npz, one array per column, covering
+# examples start to end - 1 in corpus order). each chunk is written to a
+# temporary file and renamed into place, so a crash never leaves a partial
+# chunk behind and an interrupted run can pick up after the last chunk
+columns = [
+    "index",
+    "doc_id",
+    "context_tokens",
+    "target_tokens",
+    "loss_with_context",
+    "loss_without_context",
+]
+
+class ResultStore:
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    # paths of the completed chunks, in corpus order
+    def chunk_paths(self):
+        return sorted(glob.glob(os.path.join(self.path, "chunk_*_*.npz")))
+
+    # number of examples stored so far, i.e. the index to resume from
+    def num_completed(self):
+        chunk_paths = self.chunk_paths()
+        if not chunk_paths:
+            return 0
+
+        return int(os.path.basename(chunk_paths[-1])[:-len(".npz")].split("_")[2])
+
+    # helper function to get the path of the chunk of examples start to end - 1
+    def chunk_path(self, start, end):
+        return os.path.join(self.path, f"chunk_{start:09d}_{end:09d}.npz")
+
+    # store the results (mean losses) of examples start to start + len(doc_ids) - 1
+    def append(self, start, doc_ids, token_counts, losses_with_context, losses_without_context):
+        if start != self.num_completed():
+            raise ValueError(f"chunk starting at {start} does not follow the {self.num_completed()} stored examples")
+
+        self.write_chunk(start, doc_ids, token_counts, losses_with_context, losses_without_context)
+
+    # write the chunk of examples start to start + len(doc_ids) - 1 whatever
+    # is stored so far, e.g. for shards of a corpus scored in parallel (each
+    # writing its own chunk); returns the chunk's path
+    def write_chunk(self, start, doc_ids, token_counts, losses_with_context, losses_without_context):
+        end = start + len(doc_ids)
+        token_counts = np.asarray(token_counts, dtype=np.int32).reshape(-1, 2)
+        chunk = {
+            "index": np.arange(start, end, dtype=np.int64),
+            "doc_id": np.asarray(doc_ids, dtype=np.str_),
+            "context_tokens": token_counts[:, 0],
+            "target_tokens": token_counts[:, 1],
+            # losses are stored as is; perplexity is their exponentiation
+            "loss_with_context": np.asarray(losses_with_context, dtype=np.float64),
+            "loss_without_context": np.asarray(losses_without_context, dtype=np.float64),
+        }
+
+        chunk_path = self.chunk_path(start, end)
+        with open(chunk_path + ".tmp", "wb") as f:
+            np.savez(f, **chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(chunk_path + ".tmp", chunk_path)
+
+        return chunk_path
+
+    # load every stored example as a dict of columns
+    def load(self):
+        chunks = []
+        for chunk_path in self.chunk_paths():
+            with np.load(chunk_path) as chunk:
+                chunks.append({column: chunk[column] for column in columns})
+
+        if not chunks:
+            return {column: np.zeros(0) for column in columns}
+
+        return {column: np.concatenate([chunk[column] for chunk in chunks]) for column in columns}
+
+# helper function to split documents into consecutive chunks of whole
+# documents with about chunk_size sentences each; yields (first example
+# index, documents) pairs
+def document_chunks(documents, chunk_size):
+    start = 0
+    chunk = []
+    chunk_sentences = 0
+    for document in documents:
+        chunk.append(document)
+        chunk_sentences += len(document[1])
+        if chunk_sentences >= chunk_size:
+            yield start, chunk
+            start += chunk_sentences
+            chunk = []
+            chunk_sentences = 0
+
+    if chunk:
+        yield start, chunk
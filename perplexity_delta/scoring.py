@@ -0,0 +1,348 @@
+import math
+import random
+import time
+
+import torch
+import torch.nn.functional as F
+from tqdm import tqdm
+
+from common.token_cache import cache_key, cached_token_arrays
+
+# label value ignored by the cross-entropy loss (same as transformers)
+IGNORE_INDEX = -100
+
+# helper function to tokenize all (context, target) examples in bulk;
+# a fast tokenizer encodes the whole list in one (parallel) call instead
+# of two python-level calls per example. given the corpus files the
+# examples were built from, token ids come from the on-disk token cache
+def encode_examples(tokenizer, examples, corpus_files=None):
+    context_sentences = [context_sentence for context_sentence, _ in examples]
+    target_sentences = [target_sentence for _, target_sentence in examples]
+
+    if corpus_files is None:
+        context_encodings = tokenizer(context_sentences).input_ids
+        target_encodings = tokenizer(target_sentences).input_ids
+
+        return context_encodings, target_encodings
+
+    # every corpus line is tokenized once; a line's encoding doubles
+    # as the context of the line after it
+    line_encodings = cached_line_encodings(tokenizer, target_sentences, corpus_files)
+    target_encodings = [line_encodings["sentences"][i].tolist() for i in range(len(examples))]
+    empty_encoding = line_encodings["empty"][0].tolist()
+    context_encodings = [
+        target_encodings[i - 1] if context_sentence != '' else empty_encoding
+        for i, context_sentence in enumerate(context_sentences)
+    ]
+
+    return context_encodings, target_encodings
+
+# load the token ids of every corpus line (plus those of an empty string,
+# the context at the start of a document) from the on-disk token cache,
+# tokenizing them only if the corpus files or tokenizer changed
+def cached_line_encodings(tokenizer, sentences, corpus_files):
+    return cached_token_arrays(
+        cache_key(corpus_files, tokenizer, column="sentences"),
+        lambda: {
+            "sentences": tokenizer(sentences).input_ids,
+            "empty": [tokenizer('').input_ids],
+        },
+    )
+
+# helper function to group sequence indices into length buckets; sequences
+# are sorted by length so each batch is padded to (nearly) its own length,
+# and a batch is closed once it reaches batch_size sequences or its padded
+# size would exceed max_tokens
+def length_buckets(lengths, batch_size=None, max_tokens=None):
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+
+    batches = []
+    batch = []
+    batch_width = 0
+    for i in order:
+        width = max(batch_width, lengths[i])
+        if batch and (
+            (batch_size is not None and len(batch) >= batch_size) or
+            (max_tokens is not None and width * (len(batch) + 1) > max_tokens)
+        ):
+            batches.append(batch)
+            batch = []
+            width = lengths[i]
+
+        batch.append(i)
+        batch_width = width
+
+    if batch:
+        batches.append(batch)
+
+    return batches
+
+# helper function to build a right-padded batch; tokens before each
+# sequence's label start are masked out of the loss
+def pad_batch(sequences, label_starts):
+    width = max(len(sequence) for sequence in sequences)
+
+    input_ids = torch.zeros((len(sequences), width), dtype=torch.long)
+    attention_mask = torch.zeros((len(sequences), width), dtype=torch.long)
+    labels = torch.full((len(sequences), width), IGNORE_INDEX, dtype=torch.long)
+    for row, (sequence, label_start) in enumerate(zip(sequences, label_starts)):
+        input_ids[row, :len(sequence)] = torch.tensor(sequence, dtype=torch.long)
+        attention_mask[row, :len(sequence)] = 1
+        labels[row, label_start:len(sequence)] = input_ids[row, label_start:len(sequence)]
+
+    return input_ids, attention_mask, labels
+
+# helper function to compute the mean cross-entropy loss of each row,
+# shifting labels the same way the causal LM heads do internally
+def sequence_losses(logits, labels):
+    shift_logits = logits[:, :-1, :]
+    shift_labels = labels[:, 1:]
+
+    token_losses = F.cross_entropy(
+        shift_logits.transpose(1, 2),
+        shift_labels,
+        ignore_index=IGNORE_INDEX,
+        reduction="none",
+    )
+    token_counts = (shift_labels != IGNORE_INDEX).sum(dim=1)
+
+    # rows without any scored token come out as nan, like the model's own loss
+    return token_losses.sum(dim=1) / token_counts
+
+# score many sequences, a padded length bucket per forward pass;
+# returns the mean loss over the tokens from label_starts[i] onwards
+def score_sequences(model, sequences, label_starts, batch_size=16, max_tokens=None, device="cpu"):
+    losses = [torch.tensor(math.nan)] * len(sequences)
+
+    # empty sequences have nothing to score and are left as nan
+    lengths = [len(sequence) for sequence in sequences]
+    scored = [i for i, length in enumerate(lengths) if length > 0]
+    batches = [
+        [scored[i] for i in batch]
+        for batch in length_buckets([lengths[i] for i in scored], batch_size, max_tokens)
+    ]
+    for batch in tqdm(batches):
+        input_ids, attention_mask, labels = pad_batch(
+            [sequences[i] for i in batch],
+            [label_starts[i] for i in batch],
+        )
+
+        with torch.no_grad():
+            logits = model(input_ids.to(device), attention_mask=attention_mask.to(device))[0]
+            batch_losses = sequence_losses(logits, labels.to(device)).cpu()
+
+        for row, i in enumerate(batch):
+            losses[i] = batch_losses[row]
+
+    return losses
+
+# helper function to build the with-context and without-context sequences
+# of every example, along with where the scored (target) tokens start
+def build_sequences(context_encodings, target_encodings):
+    # with context: score only the target tokens of [context, target]
+    sequences_with_context = [
+        [*context_encoding, *target_encoding]
+        for context_encoding, target_encoding in zip(context_encodings, target_encodings)
+    ]
+    label_starts_with_context = [
+        len(context_encoding) if len(target_encoding) > 0 else 0
+        for context_encoding, target_encoding in zip(context_encodings, target_encodings)
+    ]
+
+    # without context: score every token of the target sentence
+    sequences_without_context = list(target_encodings)
+    label_starts_without_context = [0] * len(target_encodings)
+
+    return sequences_with_context, label_starts_with_context, sequences_without_context, label_starts_without_context
+
+# score the with-context and without-context sequences of many examples in
+# a single forward pass per batch; both sequences of an example are packed
+# as separate rows (each with its own attention and label mask) of the same
+# padded batch, so batch_size and max_tokens count examples and padded
+# tokens over both rows
+def score_packed(model, sequences_with_context, label_starts_with_context, sequences_without_context,
+                 label_starts_without_context, batch_size=16, max_tokens=None, device="cpu"):
+    losses_with_context = [torch.tensor(math.nan)] * len(sequences_with_context)
+    losses_without_context = [torch.tensor(math.nan)] * len(sequences_without_context)
+
+    # the with-context row is the longer one, so it sets the batch width;
+    # examples with nothing to score are left as nan
+    lengths = [len(sequence) for sequence in sequences_with_context]
+    scored = [i for i, length in enumerate(lengths) if length > 0]
+    batches = [
+        [scored[i] for i in batch]
+        for batch in length_buckets(
+            [lengths[i] for i in scored],
+            batch_size,
+            max_tokens // 2 if max_tokens is not None else None,
+        )
+    ]
+    for batch in tqdm(batches):
+        input_ids, attention_mask, labels = pad_batch(
+            [sequences_with_context[i] for i in batch] + [sequences_without_context[i] for i in batch],
+            [label_starts_with_context[i] for i in batch] + [label_starts_without_context[i] for i in batch],
+        )
+
+        with torch.no_grad():
+            logits = model(input_ids.to(device), attention_mask=attention_mask.to(device))[0]
+            batch_losses = sequence_losses(logits, labels.to(device)).cpu()
+
+        for row, i in enumerate(batch):
+            losses_with_context[i] = batch_losses[row]
+            losses_without_context[i] = batch_losses[len(batch) + row]
+
+    return losses_with_context, losses_without_context
+
+# compute per-example perplexities of each target sentence with and without
+# its context sentence; gives the same values as scoring the examples
+# one at a time with batch size 1. with packed=True both perplexities of an
+# example come out of the same forward pass, otherwise the with-context and
+# without-context sequences are bucketed and scored separately
+def score_examples(model, tokenizer, examples, batch_size=16, max_tokens=None, device="cpu", packed=False,
+                   corpus_files=None):
+    context_encodings, target_encodings = encode_examples(tokenizer, examples, corpus_files)
+
+    return score_encoded_examples(model, context_encodings, target_encodings, batch_size, max_tokens, device, packed)
+
+# helper function to score already tokenized examples (see score_examples);
+# with return_losses, returns the mean losses of the examples rather than
+# their perplexities
+def score_encoded_examples(model, context_encodings, target_encodings, batch_size=16, max_tokens=None, device="cpu",
+                           packed=False, return_losses=False):
+    sequences_with_context, label_starts_with_context, sequences_without_context, label_starts_without_context = \
+        build_sequences(context_encodings, target_encodings)
+
+    if packed:
+        losses_with_context, losses_without_context = score_packed(
+            model,
+            sequences_with_context,
+            label_starts_with_context,
+            sequences_without_context,
+            label_starts_without_context,
+            batch_size,
+            max_tokens,
+            device,
+        )
+    else:
+        losses_with_context = score_sequences(
+            model, sequences_with_context, label_starts_with_context, batch_size, max_tokens, device)
+        losses_without_context = score_sequences(
+            model, sequences_without_context, label_starts_without_context, batch_size, max_tokens, device)
+
+    if return_losses:
+        return [loss.item() for loss in losses_with_context], [loss.item() for loss in losses_without_context]
+
+    # perplexity is the exponentiation of the cross-entropy loss
+    perplexities_with_context = [torch.exp(loss).item() for loss in losses_with_context]
+    perplexities_without_context = [torch.exp(loss).item() for loss in losses_without_context]
+
+    return perplexities_with_context, perplexities_without_context
+
+# reference implementation: score a single example with two batch-size-1
+# forward passes, once on [context, target] and once on target alone
+def two_pass_perplexities(model, tokenizer, example, device="cpu"):
+    context_sentence, target_sentence = example
+    context_encoding = tokenizer(context_sentence).input_ids
+    target_encoding = tokenizer(target_sentence).input_ids
+
+    # compute perplexity with context
+    input_ids_with_context = torch.tensor([[*context_encoding, *target_encoding]]).to(device)
+    target_ids_with_context = input_ids_with_context.clone()
+    # ignore loss from context sentence tokens
+    target_ids_with_context[:,:-len(target_encoding)] = -100
+
+    with torch.no_grad():
+        loss_with_context = model(input_ids_with_context, labels=target_ids_with_context)[0]
+        # perplexity is the exponentiation of the cross-entropy loss
+        perplexity_with_context = torch.exp(loss_with_context).item()
+
+    # compute perplexity without context
+    input_ids_without_context = torch.tensor([[*target_encoding]]).to(device)
+    target_ids_without_context = input_ids_without_context.clone()
+
+    with torch.no_grad():
+        loss_without_context = model(input_ids_without_context, labels=target_ids_without_context)[0]
+        # perplexity is the exponentiation of the cross-entropy loss
+        perplexity_without_context = torch.exp(loss_without_context).item()
+
+    return perplexity_with_context, perplexity_without_context
+
+# check that batched (or packed) perplexities give the same perplexity
+# deltas and percent perplexity deltas as the two-pass reference on a
+# random sample of examples; differences are measured relative to the size
+# of the perplexities involved, so deltas close to zero don't fail spuriously
+def check_against_two_pass(model, tokenizer, examples, perplexities_with_context, perplexities_without_context,
+                           sample_size=100, tolerance=1e-4, seed=0, device="cpu"):
+    indices = list(range(len(examples)))
+    random.Random(seed).shuffle(indices)
+
+    mismatches = []
+    for i in indices[:sample_size]:
+        if len(tokenizer(examples[i][1]).input_ids) == 0:
+            # the reference implementation can't score an empty target
+            continue
+
+        reference_with_context, reference_without_context = two_pass_perplexities(model, tokenizer, examples[i], device)
+        perplexity_with_context = perplexities_with_context[i]
+        perplexity_without_context = perplexities_without_context[i]
+
+        reference_finite = math.isfinite(reference_with_context) and math.isfinite(reference_without_context)
+        finite = math.isfinite(perplexity_with_context) and math.isfinite(perplexity_without_context)
+        if reference_finite != finite:
+            mismatches.append(i)
+            continue
+        if not finite:
+            continue
+
+        scale = max(reference_with_context, reference_without_context)
+        reference_delta = reference_without_context - reference_with_context
+        delta = perplexity_without_context - perplexity_with_context
+        reference_percent_delta = reference_delta / reference_without_context
+        percent_delta = delta / perplexity_without_context
+
+        if not math.isclose(delta, reference_delta, rel_tol=tolerance, abs_tol=tolerance * scale) or \
+           not math.isclose(percent_delta, reference_percent_delta, rel_tol=tolerance,
+                            abs_tol=tolerance * scale / reference_without_context):
+            mismatches.append(i)
+
+    if mismatches:
+        raise ValueError(
+            f'{len(mismatches)} of {min(sample_size, len(examples))} checked examples differ from '
+            f'the two-pass perplexity deltas (e.g. example {mismatches[0]})'
+        )
+
+# helper function to pool per-example mean losses into one perplexity over
+# every token scored, weighting each example by the number of tokens its
+# loss is the mean of (examples without a finite loss are skipped)
+def pooled_perplexity(losses, scored_tokens):
+    scored = [(count, loss) for count, loss in zip(scored_tokens, losses) if count > 0 and math.isfinite(loss)]
+
+    return math.exp(sum(count * loss for count, loss in scored) / max(sum(count for count, _ in scored), 1))
+
+# pooled perplexities of a random sample of examples with and without
+# context, plus the seconds scoring took; used to compare a quantized model
+# against the fp32 one on the same sample
+def sample_pooled_perplexities(model, tokenizer, examples, sample_size=200, seed=0, batch_size=16, max_tokens=None,
+                               device="cpu"):
+    indices = list(range(len(examples)))
+    random.Random(seed).shuffle(indices)
+    context_encodings, target_encodings = encode_examples(tokenizer, [examples[i] for i in indices[:sample_size]])
+
+    start_time = time.perf_counter()
+    losses_with_context, losses_without_context = score_encoded_examples(
+        model, context_encodings, target_encodings, batch_size, max_tokens, device, return_losses=True)
+    seconds = time.perf_counter() - start_time
+
+    # every target token is scored after a context, but without one the
+    # first target token has nothing to predict it from
+    scored_tokens_with_context = [
+        len(target_encoding) if len(context_encoding) > 0 else len(target_encoding) - 1
+        for context_encoding, target_encoding in zip(context_encodings, target_encodings)
+    ]
+    scored_tokens_without_context = [len(target_encoding) - 1 for target_encoding in target_encodings]
+
+    return (
+        pooled_perplexity(losses_with_context, scored_tokens_with_context),
+        pooled_perplexity(losses_without_context, scored_tokens_without_context),
+        seconds,
+    )
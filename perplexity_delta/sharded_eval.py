@@ -0,0 +1,166 @@
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import torch
+
+# make the shared modules at the top of the repo importable
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from preprocess import preprocess_documents, document_examples, corpus_files
+from scoring import encode_examples, score_encoded_examples
+from streaming import score_documents
+from language_models import language_models, load_language_model
+from metrics import stored_perplexity_metrics
+from result_store import ResultStore
+from common.experiments import start_experiment, finish_experiment, experiment_fingerprint
+from common.instrumentation import span, start_run, finish_run
+
+# split documents into num_shards contiguous runs of documents with
+# roughly equal numbers of sentences; documents are never split, so every
+# example keeps its context
+def shard_documents(documents, num_shards):
+    total_sentences = sum(len(sentences) for _, sentences in documents)
+
+    shards = [[] for _ in range(num_shards)]
+    sentences_so_far = 0
+    for document in documents:
+        shard_index = min(sentences_so_far * num_shards // max(total_sentences, 1), num_shards - 1)
+        shards[shard_index].append(document)
+        sentences_so_far += len(document[1])
+
+    return shards
+
+# the model loaded by this worker process, by language; tasks are queued
+# language by language, so a worker loads a language's model once for a run
+# of its shards and drops it when it moves on to the next language
+worker_models = {}
+
+def init_worker(num_threads):
+    torch.set_num_threads(num_threads)
+
+# score one shard of one language in a worker process and write its
+# per-example results as the chunk of the ResultStore at store_path that
+# starts at example start (the shard's first sentence); returns the chunk's
+# path and the number of examples and (context and target) tokens scored
+def score_shard(language, model_name, documents, params, store_path, start):
+    if language not in worker_models:
+        # only ever hold one model per worker
+        worker_models.clear()
+        worker_models[language] = load_language_model(model_name, "cpu")
+    tokenizer, model = worker_models[language]
+
+    if params["SCORING_MODE"] == "streaming":
+        losses_with_context, losses_without_context, token_counts = score_documents(
+            model, tokenizer, documents, context_size=params["CONTEXT_SIZE"], return_token_counts=True,
+            return_losses=True)
+    else:
+        context_encodings, target_encodings = encode_examples(tokenizer, document_examples(documents))
+        losses_with_context, losses_without_context = score_encoded_examples(
+            model,
+            context_encodings,
+            target_encodings,
+            batch_size=params["BATCH_SIZE"],
+            max_tokens=params["MAX_TOKENS"],
+            packed=params["SCORING_MODE"] == "packed",
+            return_losses=True,
+        )
+        token_counts = [
+            (len(context_encoding), len(target_encoding))
+            for context_encoding, target_encoding in zip(context_encodings, target_encodings)
+        ]
+
+    doc_ids = [doc_id for doc_id, sentences in documents for _ in sentences]
+    chunk_path = ResultStore(store_path).write_chunk(
+        start, doc_ids, token_counts, losses_with_context, losses_without_context)
+
+    return chunk_path, len(token_counts), sum(sum(counts) for counts in token_counts)
+
+# evaluate the language models of several languages with a shared pool of
+# worker processes; each language's eval split is split into shards by
+# document and every (language, shard) pair is a separate task. each shard
+# is stored as a chunk of the run's examples/ store (see result_store.py),
+# the same per-example results and metrics eval.py saves. languages
+# with an identical completed run are skipped, and an interrupted run only
+# scores the shards it hadn't finished. with INSTRUMENT set, the stages
+# (scoring timed across the whole pool, workers' peak RSS as that of
+# subprocesses) are saved to every experiment dir of the run
+def sharded_eval(params):
+    start_run()
+
+    tasks = []
+    experiment_dirs = {}
+    for language in params["LANGUAGES"]:
+        language_params = {
+            "LANGUAGE": language,
+            "MODEL": language_models[language],
+            **{key: value for key, value in params.items() if key != "LANGUAGES"},
+        }
+
+        # make experiment directory and save experiment params down
+        experiment_dir, status = start_experiment(
+            language_params,
+            experiment_fingerprint(corpus_files('four_way_parallel_corpus', language, 'eval'), language_models[language]),
+            subdirs=("examples",),
+            resume_incomplete=True,
+            name_suffix="_" + language,
+        )
+        if status == "completed":
+            print(f"Identical {language} run already completed in {experiment_dir}")
+            continue
+        experiment_dirs[language] = experiment_dir
+
+        documents = preprocess_documents('four_way_parallel_corpus', language, 'eval')
+        store = ResultStore(experiment_dir + "/examples")
+        start = 0
+        for shard in shard_documents(documents, params["NUM_SHARDS"]):
+            if not shard:
+                # more shards than documents
+                continue
+
+            end = start + sum(len(sentences) for _, sentences in shard)
+            if not os.path.isfile(store.chunk_path(start, end)):
+                tasks.append((language, language_models[language], shard, language_params, store.path, start))
+            start = end
+
+    with span("perplexity scoring") as scoring_span, ProcessPoolExecutor(
+        max_workers=params["NUM_WORKERS"],
+        mp_context=get_context("spawn"),
+        initializer=init_worker,
+        initargs=(params["THREADS_PER_WORKER"],),
+    ) as executor:
+        futures = [executor.submit(score_shard, *task) for task in tasks]
+        for future in futures:
+            chunk_path, num_examples, num_tokens = future.result()
+            scoring_span.add(examples=num_examples, tokens=num_tokens)
+            print(f"Finished {chunk_path}")
+
+    # the chunks are loaded in corpus order, so the metrics come out exactly as from eval.py
+    for experiment_dir in experiment_dirs.values():
+        with span("merge shards"):
+            metrics = stored_perplexity_metrics(ResultStore(experiment_dir + "/examples").load())
+        finish_experiment(experiment_dir, metrics)
+
+    finish_run(list(experiment_dirs.values()))
+
+
+if __name__ == "__main__":
+    params = {
+        # languages evaluated concurrently, each with its own model
+        "LANGUAGES": ["en", "ja", "es", "fr"],
+
+        # shards per language, worker processes and torch threads per worker;
+        # NUM_WORKERS * THREADS_PER_WORKER should not exceed the number of cores
+        "NUM_SHARDS": 8,
+        "NUM_WORKERS": 4,
+        "THREADS_PER_WORKER": max((os.cpu_count() or 1) // 4, 1),
+
+        # scoring (see eval.py)
+        "BATCH_SIZE": 16,
+        "MAX_TOKENS": None,
+        "SCORING_MODE": "packed",
+        "CONTEXT_SIZE": 1,
+    }
+
+    sharded_eval(params)
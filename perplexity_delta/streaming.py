@@ -0,0 +1,111 @@
+import math
+
+import torch
+import torch.nn.functional as F
+from tqdm import tqdm
+
+# helper function to compute the mean loss of a sentence's tokens; the first
+# token is predicted from the last logits of the preceding context (if any),
+# the rest from the sentence's own logits
+def sentence_loss(logits, encoding, prev_logits=None):
+    targets = torch.tensor(encoding, dtype=torch.long, device=logits.device)
+    if prev_logits is None:
+        predictions = logits[:-1]
+        targets = targets[1:]
+    else:
+        predictions = torch.cat([prev_logits.unsqueeze(0), logits[:-1]])
+
+    # a lone token without context has nothing to predict it, like the model's own loss
+    if len(targets) == 0:
+        return torch.tensor(math.nan)
+
+    return F.cross_entropy(predictions, targets).cpu()
+
+# helper function to run the next sentence of a stream through the model,
+# extending the cached keys / values of the sentences before it
+def stream_step(model, encoding, past_key_values, device):
+    input_ids = torch.tensor([encoding], dtype=torch.long, device=device)
+    with torch.no_grad():
+        outputs = model(input_ids, past_key_values=past_key_values, use_cache=True)
+
+    return outputs.logits[0], outputs.past_key_values
+
+# score every sentence of every document with its previous context_size
+# sentences and without context, tokenizing each sentence once (or reading
+# its token ids from line_encodings, one per corpus line): a stream starts
+# at each sentence of a document and carries past_key_values forward over
+# the following context_size sentences. a stream's first step gives the
+# sentence's context-free loss and its last step gives the loss of the
+# sentence context_size further on with exactly that much context
+# (sentences near the start of a document get whatever context precedes
+# them), so every sentence still goes through the model context_size + 1
+# times; a single cache cropped to the window would be cheaper, but its
+# keys / values would have seen context beyond the window. caches never
+# cross document boundaries.
+# line_encodings[first_line] is the encoding of the first document's first
+# sentence. with return_losses, returns the mean losses of the sentences
+# rather than their perplexities; with return_token_counts, also returns the
+# number of context and target tokens of every sentence
+def score_documents(model, tokenizer, documents, context_size=1, device="cpu", line_encodings=None, first_line=0,
+                    return_token_counts=False, return_losses=False):
+    # what an empty context tokenizes to, i.e. the context of a document's first sentence
+    empty_context_encoding = tokenizer('').input_ids
+
+    scores_with_context = []
+    scores_without_context = []
+    token_counts = []
+    line = first_line
+    for _, sentences in tqdm(documents):
+        if line_encodings is None:
+            encodings = tokenizer(sentences).input_ids
+        else:
+            encodings = [line_encodings[i].tolist() for i in range(line, line + len(sentences))]
+        line += len(sentences)
+
+        losses_with_context = [torch.tensor(math.nan)] * len(encodings)
+        losses_without_context = [torch.tensor(math.nan)] * len(encodings)
+
+        for start in range(len(encodings)):
+            past_key_values = None
+            prev_logits = None
+            for step in range(min(context_size + 1, len(encodings) - start)):
+                i = start + step
+                encoding = encodings[i]
+                if len(encoding) == 0:
+                    # empty sentences add nothing to the context
+                    continue
+
+                logits, past_key_values = stream_step(model, encoding, past_key_values, device)
+                loss = sentence_loss(logits, encoding, prev_logits)
+                prev_logits = logits[-1]
+
+                if step == 0:
+                    losses_without_context[i] = loss
+                if step == context_size or (start == 0 and step > 0):
+                    losses_with_context[i] = loss
+
+        # the first sentence's context is empty
+        if len(encodings) > 0 and len(encodings[0]) > 0:
+            if len(empty_context_encoding) == 0:
+                losses_with_context[0] = losses_without_context[0]
+            else:
+                context_logits, past_key_values = stream_step(model, empty_context_encoding, None, device)
+                logits, _ = stream_step(model, encodings[0], past_key_values, device)
+                losses_with_context[0] = sentence_loss(logits, encodings[0], context_logits[-1])
+
+        if return_losses:
+            scores_with_context.extend(loss.item() for loss in losses_with_context)
+            scores_without_context.extend(loss.item() for loss in losses_without_context)
+        else:
+            # perplexity is the exponentiation of the cross-entropy loss
+            scores_with_context.extend(torch.exp(loss).item() for loss in losses_with_context)
+            scores_without_context.extend(torch.exp(loss).item() for loss in losses_without_context)
+
+        for i, encoding in enumerate(encodings):
+            context_encodings = encodings[max(i - context_size, 0):i] if i > 0 else [empty_context_encoding]
+            token_counts.append((sum(len(context_encoding) for context_encoding in context_encodings), len(encoding)))
+
+    if return_token_counts:
+        return scores_with_context, scores_without_context, token_counts
+
+    return scores_with_context, scores_without_context